@@ -42,5 +42,27 @@ nslcd
 env | grep MYSQL > /etc/profile.d/borg.sh
 chmod +rx /etc/profile.d/borg.sh
 
+# start authorized keys server - answers the AuthorizedKeysCommand of sshd through a unix socket
+# restarted when it exits, logins fail until it listens again
+KEY_SERVER_SOCKET=${BORGHIVE_KEY_SERVER_SOCKET:-/run/borghive/authorized_keys.sock}
+mkdir -p "$(dirname "$KEY_SERVER_SOCKET")"
+rm -f "$KEY_SERVER_SOCKET"
+(
+while true
+do
+  DJANGO_SETTINGS_MODULE=core.settings_sshd /app/.venv/bin/python /app/manage.py authorized_keys_server
+  echo "authorized keys server exited with $?, restarting"
+  sleep 1
+done
+) &
+
+# wait for the socket, so the first logins do not fail
+for _ in $(seq 30)
+do
+  [[ -S "$KEY_SERVER_SOCKET" ]] && break
+  sleep 1
+done
+[[ -S "$KEY_SERVER_SOCKET" ]] || echo "authorized keys server socket $KEY_SERVER_SOCKET not ready, starting sshd anyway"
+
 # -D in CMD below prevents sshd from becoming a daemon. -e is to log everything to stderr.
 /usr/sbin/sshd -D -e
@@ -79,6 +79,16 @@ class RepositorySerializer(SimpleHyperlinkedModelSerializer):
     class Meta:
         model = Repository
         exclude = ["last_updated", "last_access"]
+        # maintained from the filesystem by the refresh and the watcher
+        read_only_fields = [
+            "size_bytes",
+            "size_verified",
+            "initialized",
+            "encrypted",
+            "storage_config",
+            "compact_bytes",
+            "compact_segments",
+        ]
 
 
 # pylint: disable=too-many-ancestors
@@ -1,7 +1,13 @@
+import datetime
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.urls import reverse
 from rest_framework.test import APIClient, APITestCase
 
+from borghive.models import Repository
+
 
 class APIRepositoryTest(APITestCase):
 
@@ -23,6 +29,43 @@ class APIRepositoryTest(APITestCase):
         self.assertEqual(response.status_code, 201)
         return response.json()
 
+    def test_api_repository_compaction_ordering(self):
+        self.test_api_repository_create()
+        data = {"name": "otherrepo", "ssh_keys": "2", "location_id": "1"}
+        self.client.post(reverse("api:repository-list"), data=data)
+        Repository.objects.filter(name="otherrepo").update(
+            compact_bytes=1024, compact_segments=2
+        )
+
+        response = self.client.get(
+            reverse("api:repository-list"), {"ordering": "-compact_bytes"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["name"], "otherrepo")
+        self.assertEqual(response.json()[0]["compact_bytes"], 1024)
+
+        # maintained by the refresh only
+        self.client.patch(response.json()[0]["_href"], data={"compact_bytes": 0})
+        self.assertEqual(Repository.objects.get(name="otherrepo").compact_bytes, 1024)
+
+    def test_api_repository_schedule(self):
+        self.test_api_repository_create()
+        response = self.client.get(reverse("api:repository-schedule"))
+        self.assertEqual(response.json()["staggered"], False)
+
+        with mock.patch.dict(
+            settings.BORGHIVE,
+            {"STAGGER": True, "STAGGER_WINDOW": "0-24", "QUIET_HOURS": "22-6"},
+        ):
+            response = self.client.get(reverse("api:repository-schedule"))
+        self.assertEqual(response.status_code, 200)
+        repository = response.json()["repositories"][0]
+        self.assertEqual(repository["name"], "testrepo")
+        next_refresh = datetime.datetime.fromisoformat(
+            repository["next_refresh"].replace("Z", "+00:00")
+        )
+        self.assertTrue(6 <= next_refresh.hour < 22)
+
     def test_api_repository_update(self):
         repository = self.test_api_repository_create()
         response = self.client.patch(repository["_href"], data={"alert_after_days": 3})
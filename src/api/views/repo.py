@@ -1,6 +1,8 @@
 import logging
 
+from django.conf import settings
 from django.db.models import Q
+from rest_framework import filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
@@ -11,6 +13,7 @@ from api.serializers import (
     RepositoryEventSerializer,
     RepositoryStatisticSerializer,
 )
+from borghive.lib.stagger import get_schedule
 from borghive.models import (
     Repository,
     RepositoryLocation,
@@ -36,6 +39,10 @@ class RepositoryViewSet(SimpleHyperlinkedModelViewSet):
     serializer_class = RepositorySerializer
     model = Repository
 
+    # ?ordering=-compact_bytes lists the repositories compact frees most in
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ["name", "last_updated", "compact_bytes", "compact_segments"]
+
     def get_queryset(self):
         return Repository.objects.by_owner_or_group(self.request.user)
 
@@ -61,6 +68,32 @@ class RepositoryViewSet(SimpleHyperlinkedModelViewSet):
         )
         return Response(serializer.data)
 
+    @action(methods=["get"], detail=False)
+    def schedule(self, request):
+        """
+        next staggered refresh and alert check of the repositories
+        """
+        data = {
+            "staggered": settings.BORGHIVE["STAGGER"],
+            "window": settings.BORGHIVE["STAGGER_WINDOW"],
+            "quiet_hours": settings.BORGHIVE["QUIET_HOURS"],
+            "repositories": [],
+        }
+        if not data["staggered"]:
+            return Response(data)
+        repos = list(self.get_queryset().values_list("id", "name"))
+        schedule = get_schedule([repo_id for repo_id, _ in repos])
+        data["repositories"] = [
+            {
+                "id": repo_id,
+                "name": name,
+                "next_refresh": schedule[repo_id][0],
+                "next_alert_check": schedule[repo_id][1],
+            }
+            for repo_id, name in repos
+        ]
+        return Response(data)
+
 
 #  pylint: disable=too-many-ancestors
 class RepositoryUserViewSet(SimpleHyperlinkedModelViewSet):
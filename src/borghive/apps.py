@@ -1,14 +1,15 @@
 from django.apps import AppConfig, apps
-from django.contrib import admin
 
 
 class BorgHiveConfig(AppConfig):
     """borghive app config"""
 
     name = "borghive"
+    default = True
 
     def ready(self):
         """initialize borghive config"""
+        from django.contrib import admin  # pylint: disable=import-outside-toplevel
         import borghive.signals  # pylint: disable=unused-import,import-outside-toplevel
         import borghive.lib.rules  # pylint: disable=unused-import,import-outside-toplevel
 
@@ -18,3 +19,13 @@ class BorgHiveConfig(AppConfig):
                 admin.site.register(model)
             except admin.sites.AlreadyRegistered:
                 pass
+
+
+class BorgHiveSshdConfig(AppConfig):
+    """
+    borghive app config for the sshd side commands (core.settings_sshd)
+
+    only provides the models, no signals and no admin
+    """
+
+    name = "borghive"
@@ -0,0 +1,219 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.db.models import BooleanField, Q, Value
+
+from borghive.models import Repository, RepositoryUser, RepositoryMode
+
+# pylint: disable=no-member
+
+LOGGER = logging.getLogger(__name__)
+
+KEY_CMD_PREFIX = 'command="'
+KEY_CMD_POSTFIX = '",restrict '
+
+
+def build_authorized_keys_line(command_options, public_key):
+    """join forced command options and public key to an authorized_keys line"""
+    return KEY_CMD_PREFIX + " ".join(command_options) + KEY_CMD_POSTFIX + public_key
+
+
+def get_fingerprint(key_blob):
+    """
+    sha256 fingerprint of a base64 encoded public key blob (sshd token %k)
+    in the format of sshd %f and SSHPublicKey.fingerprint
+    """
+    try:
+        digest = hashlib.sha256(base64.b64decode(key_blob, validate=True)).digest()
+    except (binascii.Error, ValueError) as exc:
+        raise ValueError("Invalid public key blob") from exc
+    return "SHA256:" + base64.b64encode(digest).decode("ascii").rstrip("=")
+
+
+def get_authorized_keys_rows(repo_user_name, fingerprint=None):
+    """
+    resolve the keys of a repository user with one query
+
+    returns (mode, repo name, public key, append only) tuples, the regular
+    keys first. both key relations are read with an UNION ALL of their
+    through tables.
+    """
+
+    def through_query(through, append_only):
+        query = through.objects.filter(repository__repo_user__name=repo_user_name)
+        if fingerprint:
+            query = query.filter(sshpublickey__fingerprint=fingerprint)
+        return query.annotate(
+            append_only=Value(append_only, output_field=BooleanField())
+        ).values_list(
+            "repository__mode",
+            "repository__name",
+            "sshpublickey__public_key",
+            "append_only",
+        )
+
+    rows = through_query(Repository.ssh_keys.through, False).union(
+        through_query(Repository.append_only_keys.through, True), all=True
+    )
+    return sorted(rows, key=lambda row: row[3])
+
+
+def get_authorized_keys(repo_user_name, fingerprint=None):
+    """
+    get the authorized_keys lines for a repository user
+
+    with fingerprint (sshd token %f) only the line of the offered key is
+    returned, sshd uses the first matching line anyway.
+    unknown users have no lines.
+    """
+    lines = []
+
+    for mode, repo_name, public_key, append_only in get_authorized_keys_rows(
+        repo_user_name, fingerprint=fingerprint
+    ):
+        LOGGER.debug("repo %s@%s has mode: %s", repo_user_name, repo_name, mode)
+
+        # import / export mode
+        if mode in (RepositoryMode.IMPORT, RepositoryMode.EXPORT):
+            if append_only:
+                continue
+
+            # add rrsync wrapper for import or export
+            command_options = ["/usr/bin/rrsync"]
+
+            if mode == RepositoryMode.IMPORT:
+                command_options.append("-wo")
+            elif mode == RepositoryMode.EXPORT:
+                command_options.append("-ro")
+
+            command_options.append(
+                os.path.join(settings.BORGHIVE["REPO_PATH"], repo_user_name)
+            )
+
+        elif mode == RepositoryMode.BORG:
+            repo_path = os.path.join(
+                settings.BORGHIVE["REPO_PATH"], repo_user_name, repo_name
+            )
+            if append_only:
+                # add append only mode
+                command_options = ["--append-only"]
+            else:
+                # add restrict to repository
+                command_options = ["borg serve --umask 007"]
+
+            # restrict path
+            command_options.append(f"--restrict-to-repository {repo_path}")
+
+        else:
+            LOGGER.error("I dont know which mode: %s", mode)
+            continue
+
+        lines.append(build_authorized_keys_line(command_options, public_key))
+
+    if fingerprint:
+        lines = lines[:1]
+
+    for line in lines:
+        LOGGER.debug(line)
+
+    return lines
+
+
+def get_store_path(repo_user_name):
+    """path of the precompiled authorized_keys file of a repository user"""
+    return os.path.join(settings.BORGHIVE["AUTHORIZED_KEYS_STORE_PATH"], repo_user_name)
+
+
+def get_repo_user_names_for_key(key):
+    """names of all repository users a ssh key is attached to"""
+    return list(
+        RepositoryUser.objects.filter(
+            Q(repository__ssh_keys=key) | Q(repository__append_only_keys=key)
+        )
+        .values_list("name", flat=True)
+        .distinct()
+    )
+
+
+def write_authorized_keys_file(repo_user_name):
+    """
+    (re)write the precompiled authorized_keys file of a repository user
+
+    the file is written to a temporary file and moved in place, so sshd never
+    reads a partial file. users without keys get their file removed.
+    returns True if the file changed.
+    """
+    path = get_store_path(repo_user_name)
+
+    lines = get_authorized_keys(repo_user_name)
+    if not lines:
+        return remove_authorized_keys_file(repo_user_name)
+
+    content = "".join(f"{line}\n" for line in lines)
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    LOGGER.info("authorized keys store: wrote %s", path)
+    return True
+
+
+def remove_authorized_keys_file(repo_user_name):
+    """remove the precompiled authorized_keys file, returns True if it existed"""
+    try:
+        os.unlink(get_store_path(repo_user_name))
+    except FileNotFoundError:
+        return False
+    LOGGER.info("authorized keys store: removed %s", repo_user_name)
+    return True
+
+
+def update_authorized_keys_store(repo_user_names=None):
+    """
+    update the authorized keys store
+
+    with repo_user_names only these users are rewritten (incremental),
+    otherwise all files are rebuilt and stale files are removed.
+    returns the number of changed files.
+    """
+    os.makedirs(settings.BORGHIVE["AUTHORIZED_KEYS_STORE_PATH"], exist_ok=True)
+
+    changed = 0
+    if repo_user_names is not None:
+        for name in set(repo_user_names):
+            changed += write_authorized_keys_file(name)
+        return changed
+
+    known_names = set(
+        RepositoryUser.objects.filter(repository__isnull=False).values_list(
+            "name", flat=True
+        )
+    )
+    for name in known_names:
+        changed += write_authorized_keys_file(name)
+
+    for entry in os.scandir(settings.BORGHIVE["AUTHORIZED_KEYS_STORE_PATH"]):
+        if entry.name.startswith(".") or entry.name in known_names:
+            continue
+        changed += remove_authorized_keys_file(entry.name)
+
+    return changed
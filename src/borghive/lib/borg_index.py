@@ -0,0 +1,144 @@
+import logging
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+import msgpack
+
+LOGGER = logging.getLogger(__name__)
+
+# header of borg's HashIndex (repository index.N files, not encrypted):
+# magic, entries, buckets, key size, value size - little endian, packed
+MAGIC = b"BORG_IDX"
+HEADER = struct.Struct("<8siibb")
+
+# bucket markers in the first 32 bits of the value
+EMPTY = 0xFFFFFFFF
+DELETED = 0xFFFFFFFE
+
+IndexHeader = namedtuple(
+    "IndexHeader", ["num_entries", "num_buckets", "key_size", "value_size"]
+)
+
+# freeable space of segments borg compact would rewrite
+CompactionDebt = namedtuple("CompactionDebt", ["bytes", "segments"])
+
+# hints files are small, larger files are not hints
+MAX_HINTS_SIZE = 256 * 1024 * 1024
+
+
+def get_newest_path(repo_path, prefix):
+    """path of the newest <prefix>.N of a repository, None if there is none"""
+    newest_number, newest_path = -1, None
+    try:
+        with os.scandir(repo_path) as entries:
+            for entry in entries:
+                name, _, suffix = entry.name.partition(".")
+                if name == prefix and suffix.isdigit() and int(suffix) > newest_number:
+                    newest_number, newest_path = int(suffix), entry.path
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return newest_path
+
+
+def get_index_path(repo_path):
+    """path of the newest index.N of a repository, None if there is none"""
+    return get_newest_path(repo_path, "index")
+
+
+def read_index_header(path):
+    """
+    header of a repository index file, constant cost regardless of its size
+
+    returns None if the file is missing or not a borg 1.x HashIndex.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read(HEADER.size)
+    except OSError as exc:
+        LOGGER.debug("index not readable: %s: %s", path, exc)
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, num_entries, num_buckets, key_size, value_size = HEADER.unpack(data)
+    if magic != MAGIC or num_entries < 0 or num_buckets <= 0 or value_size < 4:
+        LOGGER.warning("unknown index format: %s", path)
+        return None
+    return IndexHeader(num_entries, num_buckets, key_size, value_size)
+
+
+def count_index_entries(path):
+    """
+    count the used buckets of a repository index
+
+    reads the whole file through mmap, to verify the header count.
+    returns None if the file is not a readable index.
+    """
+    header = read_index_header(path)
+    if header is None:
+        return None
+    bucket_size = header.key_size + header.value_size
+    end = HEADER.size + header.num_buckets * bucket_size
+    marker = struct.Struct("<I")
+    count = 0
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < end:
+            LOGGER.warning("truncated index: %s", path)
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(HEADER.size + header.key_size, end, bucket_size):
+                if marker.unpack_from(data, offset)[0] not in (EMPTY, DELETED):
+                    count += 1
+    return count
+
+
+def get_chunk_count(repo_path):
+    """number of chunks in a repository from the header of its index"""
+    path = get_index_path(repo_path)
+    if path is None:
+        return None
+    header = read_index_header(path)
+    return header.num_entries if header else None
+
+
+def read_compaction_debt(path):
+    """
+    freeable bytes and segments from a hints.N file (msgpack, not encrypted)
+
+    version 2 hints map segments to freeable bytes, version 1 hints only
+    list the segments, their bytes are unknown. returns None if the file is
+    missing or not readable.
+    """
+    hints = read_hints(path)
+    compact = (hints.get("compact") or {}) if isinstance(hints, dict) else None
+    debt = None
+    if isinstance(compact, dict):
+        freeable = [size for size in compact.values() if size]
+        debt = CompactionDebt(sum(freeable), len(freeable))
+    elif isinstance(compact, (list, tuple)):
+        debt = CompactionDebt(None, len(compact))
+    return debt
+
+
+def read_hints(path):
+    """unpacked hints.N file, None if it is missing, too large or invalid"""
+    try:
+        if os.path.getsize(path) > MAX_HINTS_SIZE:
+            LOGGER.warning("hints too large: %s", path)
+            return None
+        with open(path, "rb") as f:
+            return msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+    except OSError as exc:
+        LOGGER.debug("hints not readable: %s: %s", path, exc)
+    except (ValueError, msgpack.UnpackException) as exc:
+        LOGGER.warning("invalid hints: %s: %s", path, exc)
+    return None
+
+
+def get_compaction_debt(repo_path):
+    """compaction debt of a repository from its newest hints.N"""
+    path = get_newest_path(repo_path, "hints")
+    if path is None:
+        return None
+    return read_compaction_debt(path)
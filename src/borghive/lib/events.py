@@ -0,0 +1,143 @@
+import logging
+import time
+
+from django.db import IntegrityError, transaction
+
+from borghive.models import Repository, RepositoryEvent
+from borghive.signals import handle_repository_events
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RepositoryEventBuffer:
+    """
+    buffer for watcher events
+
+    events are debounced per repository, a close directly followed by an open
+    of the same repository is collapsed (the repository stays open) and the
+    buffer is written with one bulk_create when it is full or its oldest event
+    is older than flush_interval. with a spool the events are appended to
+    the spool and written to the database by its drainer, otherwise with
+    writer(events), the bulk write and its follow up actions by default.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+
+    def __init__(
+        self,
+        debounce=2.0,
+        flush_interval=5.0,
+        flush_size=500,
+        clock=time.monotonic,
+        spool=None,
+        writer=None,
+    ):
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.clock = clock
+        self.spool = spool
+        self.writer = writer or self.write
+
+        self.pending = []
+        self.first_pending = None
+        # repo id: (message, time) of the last accepted event
+        self.last_event = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, repo_id, message):
+        """add a watcher event, returns False if it was debounced or collapsed"""
+        now = self.clock()
+
+        last_message, last_time = self.last_event.get(repo_id, (None, None))
+        if last_message == message and now - last_time < self.debounce:
+            LOGGER.debug("debounced: %s for repo %s", message, repo_id)
+            return False
+
+        if message == RepositoryEvent.REPO_OPEN and self._collapse_close(repo_id):
+            LOGGER.debug("collapsed: close/open for repo %s", repo_id)
+            self.last_event[repo_id] = (message, now)
+            return False
+
+        self.last_event[repo_id] = (message, now)
+        if not self.pending:
+            self.first_pending = now
+        self.pending.append(
+            RepositoryEvent(
+                event_type=RepositoryEvent.WATCHER, message=message, repo_id=repo_id
+            )
+        )
+
+        # without flush_size the owner of the buffer flushes by size
+        if self.flush_size and len(self.pending) >= self.flush_size:
+            self.flush()
+        return True
+
+    def _collapse_close(self, repo_id):
+        """drop a pending close event, if it is the last event of the repo"""
+        for index in range(len(self.pending) - 1, -1, -1):
+            event = self.pending[index]
+            if event.repo_id != repo_id:
+                continue
+            if event.message == RepositoryEvent.REPO_CLOSED:
+                del self.pending[index]
+                return True
+            return False
+        return False
+
+    def flush_due(self):
+        """check if the oldest pending event waited long enough"""
+        return bool(self.pending) and (
+            self.clock() - self.first_pending >= self.flush_interval
+        )
+
+    def take(self):
+        """remove and return all pending events, e.g. to write them elsewhere"""
+        events, self.pending = self.pending, []
+        self.first_pending = None
+        return events
+
+    def flush_if_due(self):
+        """flush when the time trigger is reached"""
+        if self.flush_due():
+            self.flush()
+
+    def flush(self):
+        """write or spool all pending events"""
+        if not self.pending:
+            return []
+
+        events = self.take()
+        if self.spool is not None:
+            self.spool.append(events)
+            LOGGER.debug("spooled %s repository events", len(events))
+            return events
+        return self.writer(events)
+
+    @classmethod
+    def write(cls, events):
+        """bulk write events and take the follow up actions once"""
+        events = cls.insert(events)
+        handle_repository_events(events)
+        return events
+
+    @staticmethod
+    def insert(events):
+        """bulk write events, returns the events of existing repositories"""
+        try:
+            with transaction.atomic():
+                RepositoryEvent.objects.bulk_create(events)  # pylint: disable=no-member
+        except IntegrityError:
+            # a repository was deleted meanwhile, drop its events
+            existing = set(
+                Repository.objects.filter(
+                    id__in={event.repo_id for event in events}
+                ).values_list("id", flat=True)
+            )
+            events = [event for event in events if event.repo_id in existing]
+            RepositoryEvent.objects.bulk_create(events)  # pylint: disable=no-member
+        LOGGER.info("flushed %s repository events", len(events))
+        return events
@@ -1,5 +1,4 @@
 import logging
-import requests
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,6 +22,9 @@ class Pushover:
 
     def push(self, message, **kwargs):
         """pushover to the rescue"""
+        # imported here, models import this module and requests is slow to load
+        import requests  # pylint: disable=import-outside-toplevel
+
         LOGGER.debug(
             "send pushover notification: user=%s token=%s", self.user, self.token
         )
@@ -0,0 +1,112 @@
+import datetime
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db.models import Max
+from django.utils.timezone import make_aware
+
+from borghive.models import Repository, RepositoryEvent
+
+LOGGER = logging.getLogger(__name__)
+
+RepositoryState = namedtuple("RepositoryState", ["created", "last_updated"])
+
+
+def scan_repository(path):
+    """state of a repository directory, None if it does not exist"""
+    created = False
+    index_mtime = None
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name == "README":
+                    created = True
+                elif entry.name.startswith("index."):
+                    mtime = entry.stat().st_mtime
+                    index_mtime = max(index_mtime or mtime, mtime)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    last_updated = None
+    if index_mtime is not None:
+        last_updated = make_aware(datetime.datetime.fromtimestamp(index_mtime))
+    return RepositoryState(created, last_updated)
+
+
+def get_known_repositories(user_filter=None):
+    """repositories with what the database knows about them"""
+    known_events = {}
+    for repo_id, message, last in (
+        RepositoryEvent.objects.filter(  # pylint: disable=no-member
+            event_type=RepositoryEvent.WATCHER,
+            message__in=[
+                RepositoryEvent.REPO_CREATED,
+                RepositoryEvent.REPO_UPDATED,
+                RepositoryEvent.REPO_DELETED,
+            ],
+        )
+        .values("repo_id", "message")
+        .annotate(last=Max("created"))
+        .values_list("repo_id", "message", "last")
+    ):
+        known_events.setdefault(repo_id, {})[message] = last
+
+    return [
+        (repo_id, repo_user, name, last_updated, known_events.get(repo_id, {}))
+        for repo_id, repo_user, name, last_updated in Repository.objects.values_list(
+            "id", "repo_user__name", "name", "last_updated"
+        )
+        if not user_filter or user_filter(repo_user)
+    ]
+
+
+def missing_events(state, last_updated, events):
+    """watcher messages the database misses for one repository"""
+    created_at = events.get(RepositoryEvent.REPO_CREATED)
+    deleted_at = events.get(RepositoryEvent.REPO_DELETED)
+    if created_at and (not deleted_at or created_at >= deleted_at):
+        exists = True
+    elif deleted_at:
+        exists = False
+    else:
+        # repositories from before the watcher: known if ever refreshed
+        exists = last_updated is not None
+
+    if state is None or not state.created:
+        return [RepositoryEvent.REPO_DELETED] if exists and state is None else []
+
+    messages = [] if exists else [RepositoryEvent.REPO_CREATED]
+    known_update = max(
+        filter(None, [last_updated, events.get(RepositoryEvent.REPO_UPDATED)]),
+        default=None,
+    )
+    if state.last_updated and (not known_update or state.last_updated > known_update):
+        messages.append(RepositoryEvent.REPO_UPDATED)
+    return messages
+
+
+def reconcile_repositories(repo_path, user_filter=None, workers=8):
+    """
+    compare the repositories on disk with the database
+
+    returns (repo id, message) for every event the watcher missed, the
+    directories are scanned in a thread pool.
+    """
+    repos = get_known_repositories(user_filter)
+    paths = [
+        os.path.join(repo_path, repo_user, name) for _, repo_user, name, _, _ in repos
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        states = list(executor.map(scan_repository, paths))
+
+    missing = [
+        (repo_id, message)
+        for (repo_id, _, _, last_updated, events), state in zip(repos, states)
+        for message in missing_events(state, last_updated, events)
+    ]
+    LOGGER.info(
+        "reconciled %s repositories: %s missed events", len(repos), len(missing)
+    )
+    return missing
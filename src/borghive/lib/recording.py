@@ -0,0 +1,60 @@
+import gzip
+import json
+import logging
+import time
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EventRecorder:
+    """
+    record raw inotify events to a gzip compressed json lines file
+
+    each line is [seconds since start, type names, path, filename], the
+    file is flushed every flush_interval seconds so a killed watcher leaves
+    a readable recording.
+    """
+
+    def __init__(self, path, flush_interval=1.0, clock=time.monotonic):
+        # pylint: disable=consider-using-with
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.start = clock()
+        self.flushed = self.start
+        self.recorded = 0
+
+    def record(self, event):
+        """append one (header, type names, path, filename) event"""
+        _, type_names, path, filename = event
+        offset = round(self.clock() - self.start, 6)
+        self.file.write(json.dumps([offset, type_names, path, filename]) + "\n")
+        self.recorded += 1
+
+    def flush_if_due(self):
+        """flush the compressed stream after flush_interval"""
+        now = self.clock()
+        if now - self.flushed >= self.flush_interval:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        """finish the recording"""
+        self.file.close()
+        LOGGER.info("recorded %s events", self.recorded)
+
+
+def read_recording(path):
+    """yield (offset, event) of a recording, stops at a truncated end"""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    offset, type_names, event_path, filename = json.loads(line)
+                except ValueError:
+                    LOGGER.warning("skipping broken recording line")
+                    continue
+                yield offset, (None, type_names, event_path, filename)
+    except (EOFError, zlib.error) as exc:
+        LOGGER.warning("recording ends unexpectedly: %s", exc)
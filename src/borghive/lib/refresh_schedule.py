@@ -0,0 +1,91 @@
+import heapq
+import logging
+import math
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds assumed for a repository nothing is known about
+DEFAULT_COST = 1.0
+
+
+def estimate_costs(repos):
+    """
+    expected refresh seconds per repository id
+
+    repos are (id, size in bytes, last refresh duration) tuples. repositories
+    without a duration are estimated from their size with the scan rate of
+    the measured repositories, without a size with the mean duration.
+    """
+    measured = [(size, duration) for _, size, duration in repos if duration]
+    sized = [(size, duration) for size, duration in measured if size]
+    seconds_per_byte = None
+    if sized:
+        seconds_per_byte = sum(duration for _, duration in sized) / sum(
+            size for size, _ in sized
+        )
+    mean = DEFAULT_COST
+    if measured:
+        mean = sum(duration for _, duration in measured) / len(measured)
+
+    costs = {}
+    for repo_id, size, duration in repos:
+        if duration:
+            costs[repo_id] = duration
+        elif size and seconds_per_byte:
+            costs[repo_id] = size * seconds_per_byte
+        else:
+            costs[repo_id] = mean
+    return costs
+
+
+def pack_chunks(costs, chunks):
+    """
+    distribute repository ids over chunks with similar total cost
+
+    longest processing time first: the most expensive repository goes to
+    the chunk with the least work so far, so small repositories fill the
+    gaps. returns (load, ids) per chunk, the most expensive chunk first and
+    the ids of a chunk most expensive first.
+    """
+    chunks = max(min(chunks, len(costs)), 1)
+    heap = [(0.0, index, []) for index in range(chunks)]
+    for repo_id in sorted(costs, key=lambda repo_id: (-costs[repo_id], repo_id)):
+        load, index, ids = heapq.heappop(heap)
+        ids.append(repo_id)
+        heapq.heappush(heap, (load + costs[repo_id], index, ids))
+    return sorted(
+        ((load, ids) for load, _, ids in heap if ids),
+        key=lambda chunk: -chunk[0],
+    )
+
+
+def chunk_duration(costs, ids, scan_workers):
+    """expected seconds of one chunk scanned by scan_workers threads"""
+    chunk_costs = [costs[repo_id] for repo_id in ids]
+    return max(max(chunk_costs, default=0), sum(chunk_costs) / scan_workers)
+
+
+def expected_duration(durations, workers):
+    """
+    expected seconds until all chunks are done on workers parallel tasks
+
+    the chunks are taken from the queue in the given order by the next
+    free worker.
+    """
+    free_at = [0.0] * max(workers, 1)
+    for duration in durations:
+        heapq.heapreplace(free_at, free_at[0] + duration)
+    return max(free_at)
+
+
+def plan_refresh(repos, chunk_size, workers, scan_workers):
+    """
+    chunks for the fleet refresh and the expected duration in seconds
+
+    repos are (id, size in bytes, last refresh duration) tuples, the number
+    of chunks follows from chunk_size like without scheduling.
+    """
+    costs = estimate_costs(repos)
+    chunks = pack_chunks(costs, math.ceil(len(costs) / chunk_size))
+    durations = [chunk_duration(costs, ids, scan_workers) for _, ids in chunks]
+    return [ids for _, ids in chunks], expected_duration(durations, workers)
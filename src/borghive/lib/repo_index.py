@@ -0,0 +1,121 @@
+import logging
+import time
+
+from django import db
+
+from borghive.models import Repository
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RepositoryIndex:
+    """
+    in-memory map from (repo user, repo name) to repository id
+
+    the index is loaded with one query and reloaded every refresh_interval
+    seconds (periodic diff). paths not in the index are looked up once and
+    unknown paths are remembered for miss_ttl seconds, so the hot event loop
+    does not touch the database for known or recently missed repositories.
+    with a user_filter only repositories of the accepted repo users are kept.
+    """
+
+    def __init__(
+        self,
+        refresh_interval=60.0,
+        miss_ttl=30.0,
+        clock=time.monotonic,
+        user_filter=None,
+    ):
+        self.refresh_interval = refresh_interval
+        self.miss_ttl = miss_ttl
+        self.clock = clock
+        self.user_filter = user_filter
+
+        self.repos = {}
+        self.misses = {}
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.repos)
+
+    def load(self):
+        """(re)load all repositories, returns (added, removed) keys"""
+        db.close_old_connections()
+        repos = {
+            (repo_user, name): repo_id
+            for repo_id, repo_user, name in Repository.objects.values_list(
+                "id", "repo_user__name", "name"
+            )
+            if not self.user_filter or self.user_filter(repo_user)
+        }
+        added = repos.keys() - self.repos.keys()
+        removed = self.repos.keys() - repos.keys()
+        if self.loaded_at is not None and (added or removed):
+            LOGGER.info(
+                "repository index: %s added, %s removed", len(added), len(removed)
+            )
+
+        self.repos = repos
+        self.misses = {}
+        self.loaded_at = self.clock()
+        return added, removed
+
+    def refresh_if_due(self):
+        """reload the index when refresh_interval passed"""
+        if self.loaded_at is None or (
+            self.clock() - self.loaded_at >= self.refresh_interval
+        ):
+            try:
+                self.load()
+            except db.DatabaseError as exc:
+                # keep the known repositories and retry with the next interval
+                LOGGER.warning("repository index: reload failed: %s", exc)
+                self.loaded_at = self.clock()
+
+    def is_cached(self, repo_user, repo_name):
+        """True if get answers without a database query"""
+        if self.loaded_at is None:
+            return False
+        key = (repo_user, repo_name)
+        if key in self.repos or (self.user_filter and not self.user_filter(repo_user)):
+            return True
+        missed_at = self.misses.get(key)
+        return missed_at is not None and self.clock() - missed_at < self.miss_ttl
+
+    def get(self, repo_user, repo_name):
+        """repository id for a repo user and name or None if unknown"""
+        if self.loaded_at is None:
+            self.load()
+
+        key = (repo_user, repo_name)
+        repo_id = self.repos.get(key)
+        if repo_id is not None:
+            return repo_id
+
+        if self.user_filter and not self.user_filter(repo_user):
+            return None
+
+        missed_at = self.misses.get(key)
+        if missed_at is not None and self.clock() - missed_at < self.miss_ttl:
+            return None
+
+        # new repository since the last load
+        try:
+            db.close_old_connections()
+            repo_id = (
+                Repository.objects.filter(name=repo_name, repo_user__name=repo_user)
+                .values_list("id", flat=True)
+                .first()
+            )
+        except db.DatabaseError as exc:
+            LOGGER.warning("repository index: lookup failed: %s", exc)
+            return None
+        if repo_id is None:
+            self.misses[key] = self.clock()
+        else:
+            self.repos[key] = repo_id
+        return repo_id
+
+    def discard(self, repo_user, repo_name):
+        """forget a repository, e.g. after it was deleted"""
+        self.repos.pop((repo_user, repo_name), None)
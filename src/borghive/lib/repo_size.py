@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from borghive.models import Repository
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_data_size(repo_path):
+    """apparent size in bytes of all files in data/ of a repository"""
+    total = 0
+    stack = [os.path.join(repo_path, "data")]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return total
+
+
+class RepositorySizeTracker:
+    """
+    running byte count per repository from segment file events
+
+    written segments are stat'ed when they are closed and added as delta.
+    the size of a removed segment is only known if it was written while
+    tracking and is one of the last max_segments written, otherwise the
+    repository is scanned once at the next flush.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, flush_interval=5.0, clock=time.monotonic, max_segments=100000):
+        self.flush_interval = flush_interval
+        self.max_segments = max_segments
+        self.clock = clock
+        self.last_flush = clock()
+
+        self.lock = threading.Lock()
+        self.deltas = defaultdict(int)
+        # repo id: repository directory, size must be scanned
+        self.dirty = {}
+        # segment path: size of the segments last written while tracking
+        self.segments = OrderedDict()
+
+    def segment_written(self, repo_id, segment):
+        """a segment file was closed after writing or moved in"""
+        try:
+            size = os.stat(segment).st_size
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.deltas[repo_id] += size - self.segments.get(segment, 0)
+            self.segments[segment] = size
+            self.segments.move_to_end(segment)
+            if len(self.segments) > self.max_segments:
+                # borg compacts old segments rarely, their removal rescans
+                self.segments.popitem(last=False)
+
+    def segment_removed(self, repo_id, repo_path, segment):
+        """a segment file was deleted or moved away"""
+        with self.lock:
+            size = self.segments.pop(segment, None)
+            if size is None:
+                self.dirty[repo_id] = repo_path
+            else:
+                self.deltas[repo_id] -= size
+
+    def take(self):
+        """remove and return the pending deltas and repositories to scan"""
+        with self.lock:
+            deltas, self.deltas = self.deltas, defaultdict(int)
+            dirty, self.dirty = self.dirty, {}
+        self.last_flush = self.clock()
+        return deltas, dirty
+
+    def restore(self, deltas, dirty):
+        """put back pending work that could not be written"""
+        with self.lock:
+            for repo_id, delta in deltas.items():
+                self.deltas[repo_id] += delta
+            self.dirty.update(dirty)
+
+    def write(self, deltas, dirty):
+        """apply deltas and scan the dirty repositories"""
+        try:
+            with transaction.atomic():
+                for repo_id, delta in deltas.items():
+                    if delta and repo_id not in dirty:
+                        # repositories never scanned keep no size
+                        Repository.objects.filter(
+                            id=repo_id, size_bytes__isnull=False
+                        ).update(size_bytes=F("size_bytes") + delta)
+        except DatabaseError as exc:
+            LOGGER.warning("repository sizes not written: %s", exc)
+            self.restore(deltas, dirty)
+            return
+
+        try:
+            for repo_id, repo_path in dirty.items():
+                Repository.objects.filter(id=repo_id).update(
+                    size_bytes=get_data_size(repo_path), size_verified=timezone.now()
+                )
+        except DatabaseError as exc:
+            # scanning again is harmless
+            LOGGER.warning("repository sizes not written: %s", exc)
+            self.restore({}, dirty)
+
+    def flush(self):
+        """write all pending size changes"""
+        deltas, dirty = self.take()
+        if deltas or dirty:
+            self.write(deltas, dirty)
+
+    def flush_due(self):
+        """True if the last flush is older than flush_interval"""
+        return self.clock() - self.last_flush >= self.flush_interval
+
+    def flush_if_due(self):
+        """flush after flush_interval"""
+        if self.flush_due():
+            self.flush()
+
+
+def verify_repository_sizes(repos):
+    """full scan of the repositories, returns the repositories which drifted"""
+    now = timezone.now()
+    drifted = []
+    for repo in repos:
+        size = get_data_size(repo.get_repo_path()) if repo.is_created() else None
+        if repo.size_bytes is not None and size != repo.size_bytes:
+            LOGGER.warning("size of %s drifted: %s != %s", repo, repo.size_bytes, size)
+            drifted.append(repo)
+        repo.size_bytes = size
+        repo.size_verified = now
+    Repository.objects.bulk_update(
+        repos, ["size_bytes", "size_verified"], batch_size=500
+    )
+    return drifted
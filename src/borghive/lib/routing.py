@@ -0,0 +1,59 @@
+import re
+
+from django.conf import settings
+
+from borghive.models import Repository, RepositoryLocation
+
+# queue of the workers co-located with a storage location, see docs/internals.rst
+LOCATION_QUEUE = "location.{}"
+
+
+def location_queue(name):
+    """queue name of a location, e.g. "location.storage1.example.com" """
+    return LOCATION_QUEUE.format(re.sub(r"[^\w.-]+", "-", name))
+
+
+def route_options(queue):
+    """apply_async options of a queue, none keeps the default routing"""
+    return {"queue": queue} if queue else {}
+
+
+def get_location_queue(location_id):
+    """queue of a repository location, None without location routing"""
+    if not settings.BORGHIVE["LOCATION_ROUTING"]:
+        return None
+    name = (
+        RepositoryLocation.objects.filter(id=location_id)  # pylint: disable=no-member
+        .values_list("name", flat=True)
+        .first()
+    )
+    return location_queue(name) if name else None
+
+
+def get_repo_queue(repo_id):
+    """queue of the location of a repository, None without location routing"""
+    if not settings.BORGHIVE["LOCATION_ROUTING"]:
+        return None
+    name = (
+        Repository.objects.filter(id=repo_id)
+        .values_list("location__name", flat=True)
+        .first()
+    )
+    return location_queue(name) if name else None
+
+
+def group_by_queue(repos):
+    """
+    group (location name, item) pairs by the queue of their location
+
+    keeps the order of the items, all items share the None queue without
+    location routing.
+    """
+    groups = {}
+    for name, item in repos:
+        if settings.BORGHIVE["LOCATION_ROUTING"]:
+            queue = location_queue(name)
+        else:
+            queue = None
+        groups.setdefault(queue, []).append(item)
+    return groups
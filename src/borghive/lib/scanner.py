@@ -0,0 +1,232 @@
+import datetime
+import logging
+import math
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.timezone import make_aware
+
+from borghive.lib.borg_index import read_compaction_debt, read_index_header
+from borghive.lib.repo_size import get_data_size
+from borghive.models import Repository, RepositoryStatistic
+from borghive.models.repository import parse_storage_config
+
+LOGGER = logging.getLogger(__name__)
+
+RepositoryScan = namedtuple(
+    "RepositoryScan",
+    [
+        "created",
+        "encrypted",
+        "storage_config",
+        "last_updated",
+        "last_access",
+        "size_bytes",
+        "chunk_count",
+        "compaction_debt",
+        "duration",
+        "error",
+    ],
+    defaults=[None],
+)
+
+# rows per bulk query
+BATCH_SIZE = 500
+
+
+def scan_repository_dir(path):
+    """
+    everything the refresh needs of a repository directory in one pass
+
+    returns None if the directory does not exist and a scan with the error
+    if it is not readable. times are timestamps so the result can be
+    returned from a process pool.
+    """
+    started = time.monotonic()
+    try:
+        return _scan_repository_dir(path, started)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except OSError as exc:
+        # e.g. a permission error, the other repositories are still scanned
+        LOGGER.warning("scan failed: %s: %s", path, exc)
+        return RepositoryScan(
+            False,
+            False,
+            None,
+            None,
+            None,
+            None,
+            None,
+            None,
+            time.monotonic() - started,
+            error=str(exc),
+        )
+
+
+def _scan_repository_dir(path, started):
+    last_access = os.stat(path).st_mtime
+    created, index_mtime, newest = _list_repository_dir(path)
+
+    encrypted = False
+    storage_config = None
+    size_bytes = None
+    chunk_count = None
+    compaction_debt = None
+    if created:
+        encrypted, storage_config = _read_config(path)
+        size_bytes = get_data_size(path)
+        chunk_count, compaction_debt = _read_index_files(newest)
+    return RepositoryScan(
+        created,
+        encrypted,
+        storage_config,
+        index_mtime,
+        last_access,
+        size_bytes,
+        chunk_count,
+        compaction_debt,
+        time.monotonic() - started,
+    )
+
+
+def _list_repository_dir(path):
+    """
+    config presence, newest index mtime and the newest index.N and hints.N
+    as {prefix: (N, path)} of a repository directory
+    """
+    created = False
+    index_mtime = None
+    newest = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == "config" and entry.is_file():
+                created = True
+                continue
+            prefix, _, number = entry.name.partition(".")
+            if entry.name.startswith("index."):
+                mtime = entry.stat().st_mtime
+                index_mtime = max(index_mtime or mtime, mtime)
+            if prefix in ("index", "hints") and number.isdigit():
+                if int(number) > newest.get(prefix, (-1, None))[0]:
+                    newest[prefix] = (int(number), entry.path)
+    return created, index_mtime, newest
+
+
+def _read_config(path):
+    """encryption and storage config of the repository config"""
+    config_path = os.path.join(path, "config")
+    with open(config_path, "r", encoding="utf-8", errors="replace") as f:
+        config = f.read()
+    return "key =" in config, parse_storage_config(config)
+
+
+def _read_index_files(newest):
+    """chunk count of the newest index and compaction debt of the newest hints"""
+    chunk_count = None
+    compaction_debt = None
+    if "index" in newest:
+        header = read_index_header(newest["index"][1])
+        chunk_count = header.num_entries if header else None
+    if "hints" in newest:
+        compaction_debt = read_compaction_debt(newest["hints"][1])
+    return chunk_count, compaction_debt
+
+
+def scan_repositories(paths, workers=None, pool=None):
+    """scan the repository directories in a thread or process pool"""
+    workers = workers or settings.BORGHIVE["SCAN_WORKERS"]
+    pool = pool or settings.BORGHIVE["SCAN_POOL"]
+    executor_class = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        return list(executor.map(scan_repository_dir, paths, chunksize=16))
+
+
+def _aware(timestamp):
+    if timestamp is None:
+        return None
+    return make_aware(datetime.datetime.fromtimestamp(timestamp))
+
+
+def refresh_repositories(repos, workers=None, pool=None):
+    """
+    refresh access infos, filesystem state, size and statistic of many
+    repositories
+
+    the directories are scanned once in a pool and the results are written
+    with bulk queries, returns the refreshed and the unreadable repositories.
+    """
+    repos = list(repos)
+    scans = scan_repositories(
+        [repo.get_repo_path() for repo in repos], workers=workers, pool=pool
+    )
+
+    now = timezone.now()
+    refreshed = []
+    failed = []
+    statistics = []
+    for repo, scan in zip(repos, scans):
+        if scan is not None and scan.error:
+            # keep the last known state of an unreadable repository
+            failed.append(repo)
+            continue
+        if scan is None or not scan.created:
+            LOGGER.debug("refresh: not created: %s", repo.name)
+            repo.initialized = False
+            continue
+        repo.initialized = True
+        repo.encrypted = scan.encrypted
+        repo.storage_config = scan.storage_config
+        repo.compact_bytes, repo.compact_segments = scan.compaction_debt or (
+            None,
+            None,
+        )
+        repo.last_updated = _aware(scan.last_updated)
+        repo.last_access = _aware(scan.last_access)
+        repo.size_bytes = scan.size_bytes
+        repo.size_verified = now
+        repo.refresh_duration = scan.duration
+        refreshed.append(repo)
+        statistics.append(
+            RepositoryStatistic(
+                repo=repo,
+                repo_size=math.ceil(scan.size_bytes / (1024 * 1024)),
+                repo_size_unit="MB",
+                chunk_count=scan.chunk_count,
+            )
+        )
+
+    Repository.objects.bulk_update(
+        refreshed,
+        [
+            "last_updated",
+            "last_access",
+            "size_bytes",
+            "size_verified",
+            "initialized",
+            "encrypted",
+            "storage_config",
+            "compact_bytes",
+            "compact_segments",
+            "refresh_duration",
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    # repositories removed from disk
+    Repository.objects.filter(
+        id__in=[repo.id for repo in repos if not repo.initialized]
+    ).exclude(initialized=False).update(initialized=False)
+    RepositoryStatistic.objects.bulk_create(  # pylint: disable=no-member
+        statistics, batch_size=BATCH_SIZE
+    )
+    LOGGER.info(
+        "refreshed %s of %s repositories, %s failed",
+        len(refreshed),
+        len(repos),
+        len(failed),
+    )
+    return refreshed, failed
@@ -0,0 +1,224 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from django import db
+
+from borghive.models import RepositoryEvent
+
+LOGGER = logging.getLogger(__name__)
+
+# retry delay of the drainer doubles up to this many seconds
+MAX_RETRY_DELAY = 60
+
+
+class EventSpool:
+    """
+    append-only on-disk spool for watcher events
+
+    events are appended as json lines to the current segment file, which is
+    fsynced at most every fsync_interval seconds. the drainer rotates the
+    segment and writes closed segments to the database, so events survive a
+    database outage and a restart of the watcher.
+    """
+
+    SUFFIX = ".jsonl"
+
+    def __init__(self, path, fsync_interval=1.0, clock=time.monotonic):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.dirty_since = None
+
+    def append(self, events):
+        """append RepositoryEvents to the current segment"""
+        data = "".join(
+            json.dumps(
+                {
+                    "repo": event.repo_id,
+                    "message": event.message,
+                    "time": event.created.timestamp(),
+                }
+            )
+            + "\n"
+            for event in events
+        )
+        with self.lock:
+            if self.file is None:
+                segment = os.path.join(self.path, f"{time.time_ns():020d}{self.SUFFIX}")
+                # pylint: disable=consider-using-with
+                self.file = open(segment, "a", encoding="utf-8")
+            self.file.write(data)
+            self.file.flush()
+            if self.dirty_since is None:
+                self.dirty_since = self.clock()
+
+    def _sync(self):
+        """fsync the current segment - lock must be held"""
+        if self.file is not None and self.dirty_since is not None:
+            os.fsync(self.file.fileno())
+            self.dirty_since = None
+
+    def sync_if_due(self):
+        """fsync when the oldest unsynced write is older than fsync_interval"""
+        with self.lock:
+            if (
+                self.dirty_since is not None
+                and self.clock() - self.dirty_since >= self.fsync_interval
+            ):
+                self._sync()
+
+    def rotate(self):
+        """close the current segment, the next append starts a new one"""
+        with self.lock:
+            self._sync()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    close = rotate
+
+    def segments(self):
+        """closed segments, oldest first"""
+        with self.lock:
+            current = self.file.name if self.file is not None else None
+        return [
+            segment
+            for segment in sorted(glob.glob(os.path.join(self.path, "*" + self.SUFFIX)))
+            if segment != current
+        ]
+
+    @staticmethod
+    def read_segment(segment):
+        """RepositoryEvents of a segment, skips a torn last line after a crash"""
+        events = []
+        with open(segment, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    event = RepositoryEvent(
+                        event_type=RepositoryEvent.WATCHER,
+                        message=record["message"],
+                        repo_id=record["repo"],
+                    )
+                    # when the event happened, not when it is drained
+                    if "time" in record:
+                        event.created = datetime.datetime.fromtimestamp(
+                            record["time"], tz=datetime.timezone.utc
+                        )
+                    events.append(event)
+                except (ValueError, KeyError, TypeError):
+                    LOGGER.warning("skipping broken spool line in %s", segment)
+        return events
+
+    def backlog(self):
+        """spooled segments, bytes and age in seconds of the oldest segment"""
+        segments = sorted(glob.glob(os.path.join(self.path, "*" + self.SUFFIX)))
+        size = 0
+        for segment in segments:
+            try:
+                size += os.path.getsize(segment)
+            except FileNotFoundError:
+                pass
+        age = 0.0
+        if segments:
+            created_ns = int(os.path.basename(segments[0])[: -len(self.SUFFIX)])
+            age = max(time.time() - created_ns / 1e9, 0.0)
+        return {"segments": len(segments), "bytes": size, "age": age}
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    background thread writing spooled events with writer(events)
+
+    a failing database is retried with an increasing delay, the backlog is
+    logged while it is not drained. a segment is removed once it is written,
+    follow_up(written events) runs afterwards and its errors are only logged.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, spool, writer, interval=1.0, follow_up=None):
+        super().__init__(name="spool-drainer", daemon=True)
+        self.spool = spool
+        self.writer = writer
+        self.follow_up = follow_up
+        self.interval = interval
+        self.delay = interval
+        self.stopped = threading.Event()
+
+        self.drained = 0
+        self.failures = 0
+
+    def stop(self):
+        """drain a last time and end the thread"""
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        while not self.stopped.wait(self.delay):
+            self.drain_logged()
+        self.drain_logged()
+        db.connection.close()
+
+    def drain_logged(self):
+        """drain, unexpected errors are retried and must not end the thread"""
+        try:
+            self.drain()
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception(exc)
+            self.retry_later("drain failed", exc)
+
+    def retry_later(self, reason, exc):
+        """double the delay of the next drain"""
+        self.failures += 1
+        self.delay = min(self.interval * 2**self.failures, MAX_RETRY_DELAY)
+        LOGGER.warning(
+            "spool: %s, retry in %ss: %s: %s",
+            reason,
+            self.delay,
+            self.spool.backlog(),
+            exc,
+        )
+
+    def drain(self):
+        """write all closed segments, returns False if the database failed"""
+        self.spool.rotate()
+        for segment in self.spool.segments():
+            events = self.spool.read_segment(segment)
+            try:
+                db.close_old_connections()
+                written = self.writer(events) if events else []
+            except db.DatabaseError as exc:
+                self.retry_later("database unavailable", exc)
+                return False
+            # committed, a restart must not write the segment again
+            os.unlink(segment)
+            self.drained += len(events)
+            if self.follow_up is not None and written:
+                try:
+                    self.follow_up(written)
+                except Exception as exc:  # pylint: disable=broad-except
+                    LOGGER.error(
+                        "spool: follow up actions of %s events failed: %s",
+                        len(written),
+                        exc,
+                    )
+
+        if self.failures:
+            LOGGER.info("spool: drained after %s failures", self.failures)
+        self.failures = 0
+        self.delay = self.interval
+        return True
+
+    def stats(self):
+        """backpressure metrics"""
+        return dict(self.spool.backlog(), drained=self.drained, failures=self.failures)
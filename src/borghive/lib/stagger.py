@@ -0,0 +1,113 @@
+import datetime
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+DAY = 24 * 3600
+HOUR = 3600
+
+
+def parse_hours(value):
+    """
+    "<start>-<end>" band of local hours, e.g. "22-6" - empty for none
+
+    returns (start, end) in seconds of the day, the band may wrap midnight.
+    """
+    if not value:
+        return None
+    start, end = (int(hour) for hour in value.split("-"))
+    if not (0 <= start <= 24 and 0 <= end <= 24):
+        raise ValueError(f"invalid hours: {value}")
+    return start * HOUR, end * HOUR
+
+
+def _band(hours):
+    """intervals of a band within one day"""
+    start, end = hours
+    if start < end:
+        return [(start, end)]
+    if start == end:
+        return [(0, DAY)]
+    return [(0, end), (start, DAY)]
+
+
+def allowed_intervals(window, quiet=None):
+    """
+    seconds of the day within the window and outside of the quiet hours
+
+    window and quiet are (start, end) tuples of parse_hours.
+    """
+    intervals = _band(window)
+    for quiet_start, quiet_end in _band(quiet) if quiet else []:
+        intervals = [
+            part
+            for start, end in intervals
+            for part in (
+                (start, min(end, quiet_start)),
+                (max(start, quiet_end), end),
+            )
+            if part[0] < part[1]
+        ]
+    if not intervals:
+        raise ValueError("the quiet hours cover the whole refresh window")
+    return sorted(intervals)
+
+
+def get_intervals():
+    """allowed refresh intervals of the configured window and quiet hours"""
+    return allowed_intervals(
+        parse_hours(settings.BORGHIVE["STAGGER_WINDOW"]),
+        parse_hours(settings.BORGHIVE["QUIET_HOURS"]),
+    )
+
+
+def slot(repo_id, purpose, length):
+    """deterministic position of a repository in [0, length)"""
+    return zlib.crc32(f"{purpose}:{repo_id}".encode()) % length
+
+
+def refresh_offset(repo_id, intervals):
+    """second of the day of the daily refresh of a repository"""
+    position = slot(repo_id, "refresh", sum(end - start for start, end in intervals))
+    for start, end in intervals:
+        if position < end - start:
+            return start + position
+        position -= end - start
+    raise ValueError("empty intervals")  # not reached
+
+
+def alert_offset(repo_id):
+    """second of the hour of the hourly alert check of a repository"""
+    return slot(repo_id, "alert", HOUR)
+
+
+def next_run(offset, period, after):
+    """first time after `after` at offset seconds into a day or an hour"""
+    local = timezone.localtime(after)
+    if period == DAY:
+        start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = local.replace(minute=0, second=0, microsecond=0)
+    run = start + datetime.timedelta(seconds=offset)
+    if run <= after:
+        run += datetime.timedelta(seconds=period)
+    return run
+
+
+def is_due(offset, period, since, now):
+    """True if the run at offset fell into (since, now]"""
+    return next_run(offset, period, since) <= now
+
+
+def get_schedule(repo_ids, now=None, intervals=None):
+    """next refresh and alert check per repository id"""
+    now = now or timezone.now()
+    intervals = intervals or get_intervals()
+    return {
+        repo_id: (
+            next_run(refresh_offset(repo_id, intervals), DAY, now),
+            next_run(alert_offset(repo_id), HOUR, now),
+        )
+        for repo_id in repo_ids
+    }
@@ -0,0 +1,330 @@
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import zlib
+from errno import ENOENT
+
+import inotify.calls
+from inotify import constants
+
+LOGGER = logging.getLogger(__name__)
+
+# root and user directories: repository users and repositories come and go
+DIRECTORY_MASK = (
+    constants.IN_CREATE
+    | constants.IN_MOVED_TO
+    | constants.IN_DELETE
+    | constants.IN_MOVED_FROM
+    | constants.IN_ONLYDIR
+)
+
+# repository directories: lock.roster, README, index.* and the repo itself
+REPOSITORY_MASK = (
+    constants.IN_CREATE
+    | constants.IN_DELETE
+    | constants.IN_MOVED_TO
+    | constants.IN_DELETE_SELF
+    | constants.IN_ONLYDIR
+)
+
+# segment directories with --track-size: segment files written or removed
+SEGMENT_MASK = (
+    constants.IN_CLOSE_WRITE
+    | constants.IN_DELETE
+    | constants.IN_MOVED_TO
+    | constants.IN_MOVED_FROM
+    | constants.IN_ONLYDIR
+)
+
+USER_DEPTH = 1
+REPOSITORY_DEPTH = 2
+DATA_DEPTH = 3
+SEGMENT_DEPTH = 4
+
+# struct inotify_event: wd, mask, cookie, len - followed by the name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 65536
+OVERFLOW = "IN_Q_OVERFLOW"
+
+
+def path_depth(repo_path, path):
+    """
+    directory level below repo_path: 0 root, 1 repo user, 2 repository,
+    3 data and 4 segment directory
+    """
+    relative = os.path.relpath(path, repo_path)
+    if relative == ".":
+        return 0
+    return relative.count("/") + 1
+
+
+def event_names(mask):
+    """inotify type names of an event mask"""
+    return [name for bit, name in constants.MASK_LOOKUP.items() if mask & bit]
+
+
+def decode_events(data):
+    """decode raw inotify data, returns ([(wd, mask, filename)], rest)"""
+    events = []
+    offset = 0
+    while len(data) - offset >= EVENT_HEADER.size:
+        wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+        end = offset + EVENT_HEADER.size + length
+        if end > len(data):
+            break
+        start = offset + EVENT_HEADER.size
+        filename = data[start:end].rstrip(b"\0")
+        events.append((wd, mask, filename.decode("utf-8", "surrogateescape")))
+        offset = end
+    return events, data[offset:]
+
+
+def shard_of(repo_user, shards):
+    """stable shard number of a repo user, the same in every process"""
+    return zlib.crc32(repo_user.encode("utf-8")) % shards
+
+
+def shard_filter(shards, shard):
+    """predicate for the repo users owned by shard, None without sharding"""
+    if shards <= 1:
+        return None
+    return lambda repo_user: shard_of(repo_user, shards) == shard
+
+
+class RepositoryWatches:  # pylint: disable=too-many-instance-attributes
+    """
+    inotify watches on the repository root, the repo user directories and the
+    repository directories only
+
+    segment directories (data/<n>/) are never watched and every directory
+    only reports the event types the watcher interprets. watches of new
+    users and repositories are added when their directories appear.
+
+    with a user_filter only the repo users it accepts are watched, so several
+    watchers can share one repository root. with track_size the data and
+    segment directories are watched for written and removed segment files.
+    changes of the watch set are locked, load may run in a thread while the
+    events are read.
+    """
+
+    def __init__(
+        self, repo_path, block_duration_s=1, user_filter=None, track_size=False
+    ):
+        self.repo_path = repo_path.rstrip("/") or "/"
+        self.user_filter = user_filter
+        self.track_size = track_size
+        self.block_duration_s = block_duration_s
+
+        self.fd = inotify.calls.inotify_init()
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.wds = {}
+        self.wd_paths = {}
+        self.data = b""
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """close the inotify fd, removes all watches"""
+        if getattr(self, "fd", None) is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+        """inotify fd, e.g. for an event loop reader"""
+        return self.fd
+
+    def load(self):
+        """watch the root and all existing users and repositories"""
+        self.add_watch(self.repo_path, DIRECTORY_MASK)
+        for user_path in self._subdirectories(self.repo_path):
+            self.add_user(user_path)
+        LOGGER.info("watching %s directories in %s", len(self), self.repo_path)
+
+    def add_watch(self, path, mask):
+        """add one watch, returns False if the directory is already gone"""
+        with self.lock:
+            if path in self.paths:
+                return True
+            try:
+                wd = inotify.calls.inotify_add_watch(
+                    self.fd, path.encode("utf-8", "surrogateescape"), mask
+                )
+            except inotify.calls.InotifyError as exc:
+                if exc.errno == ENOENT:
+                    LOGGER.debug("directory disappeared before watching: %s", path)
+                    return False
+                raise
+            self.paths.add(path)
+            self.wds[path] = wd
+            self.wd_paths[wd] = path
+            return True
+
+    def add_user(self, path):
+        """watch a repo user directory and its repositories"""
+        if self.user_filter and not self.user_filter(os.path.basename(path)):
+            return
+        if self.add_watch(path, DIRECTORY_MASK):
+            for repo_path in self._subdirectories(path):
+                self.add_repository(repo_path)
+
+    def add_repository(self, path):
+        """watch a repository directory and with track_size its segments"""
+        if not self.add_watch(path, REPOSITORY_MASK):
+            return False
+        if self.track_size:
+            self.add_data(os.path.join(path, "data"))
+        return True
+
+    def add_data(self, path):
+        """watch the data directory and the segment directories of a repository"""
+        if not self.add_watch(path, DIRECTORY_MASK):
+            return False
+        for segment_path in self._subdirectories(path):
+            self.add_watch(segment_path, SEGMENT_MASK)
+        return True
+
+    def remove(self, path, superficial):
+        """forget the watch of a directory and all watches below it"""
+        prefix = path + "/"
+        with self.lock:
+            removed = [p for p in self.paths if p == path or p.startswith(prefix)]
+            for watched in removed:
+                self.paths.discard(watched)
+                wd = self.wds.pop(watched)
+                if self.wd_paths.get(wd) == watched:
+                    del self.wd_paths[wd]
+                if superficial:
+                    continue
+                try:
+                    inotify.calls.inotify_rm_watch(self.fd, wd)
+                except inotify.calls.InotifyError as exc:
+                    LOGGER.debug("removing watch of %s failed: %s", watched, exc)
+
+    def read_events(self):
+        """
+        read the available events from the fd
+
+        yields (mask, type names, path, filename) and keeps the watch set in
+        sync. a queue overflow of the kernel is yielded with the type name
+        IN_Q_OVERFLOW and path None - events were lost.
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        events, self.data = decode_events(self.data + data)
+        for wd, mask, filename in events:
+            if mask & constants.IN_Q_OVERFLOW:
+                LOGGER.warning("inotify queue overflow: events were lost")
+                yield (mask, [OVERFLOW], None, "")
+                continue
+            path = self.wd_paths.get(wd)
+            if path is None:
+                continue
+            if mask & constants.IN_IGNORED:
+                # the kernel dropped the watch
+                with self.lock:
+                    self.paths.discard(path)
+                    self.wds.pop(path, None)
+                    self.wd_paths.pop(wd, None)
+            event = (mask, event_names(mask), path, filename)
+            yield event
+            yield from self._update_watches(event)
+
+    def event_gen(self, timeout_s=None, yield_nones=True):
+        """
+        blocking event generator, yields None after every poll when
+        yield_nones and ends when no event arrived for timeout_s seconds
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        last_event = time.monotonic()
+        while True:
+            if poller.poll(self.block_duration_s * 1000):
+                for event in self.read_events():
+                    last_event = time.monotonic()
+                    yield event
+            if timeout_s is not None and time.monotonic() - last_event > timeout_s:
+                return
+            if yield_nones:
+                yield None
+
+    def _update_watches(self, event):
+        """add or remove watches for created or removed directories"""
+        mask, _, path, filename = event
+        if not mask & constants.IN_ISDIR:
+            return
+
+        full_path = os.path.join(path, filename)
+        depth = path_depth(self.repo_path, full_path)
+        if depth > (SEGMENT_DEPTH if self.track_size else REPOSITORY_DEPTH):
+            return
+        if depth == DATA_DEPTH and filename != "data":
+            return
+
+        if mask & (constants.IN_CREATE | constants.IN_MOVED_TO):
+            yield from self._add_directory(full_path, depth)
+        elif mask & constants.IN_DELETE:
+            # the kernel already dropped the watch of a deleted directory
+            self.remove(full_path, superficial=True)
+        elif mask & constants.IN_MOVED_FROM:
+            self.remove(full_path, superficial=False)
+
+    def _add_directory(self, path, depth):
+        """
+        watch a new directory, yields synthetic events of the files written
+        before the watch existed
+        """
+        if depth == USER_DEPTH:
+            self.add_user(path)
+        elif depth == DATA_DEPTH:
+            if self.add_data(path):
+                for segment_path in self._subdirectories(path):
+                    yield from self._written_segments(segment_path)
+        elif depth == SEGMENT_DEPTH:
+            if self.add_watch(path, SEGMENT_MASK):
+                yield from self._written_segments(path)
+        elif self.add_repository(path):
+            # borg may have written the README before the watch existed
+            if os.path.exists(os.path.join(path, "README")):
+                yield (None, ["IN_CREATE"], path, "README")
+
+    @staticmethod
+    def _written_segments(path):
+        """
+        synthetic IN_CLOSE_WRITE events of the segments in a new segment
+        directory - borg may have written them before the watch existed,
+        events of segments also seen by the watch are counted once
+        """
+        try:
+            with os.scandir(path) as entries:
+                names = [
+                    entry.name
+                    for entry in entries
+                    if entry.is_file(follow_symlinks=False)
+                ]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for name in names:
+            yield (None, ["IN_CLOSE_WRITE"], path, name)
+
+    @staticmethod
+    def _subdirectories(path):
+        """directories in path, empty if path disappeared"""
+        try:
+            with os.scandir(path) as entries:
+                return [
+                    entry.path
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                ]
+        except (FileNotFoundError, NotADirectoryError):
+            return []
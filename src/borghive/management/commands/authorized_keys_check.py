@@ -1,18 +1,13 @@
 import logging
 
-import os
-from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from borghive.models import RepositoryUser, RepositoryMode
+from borghive.lib.authorized_keys import get_authorized_keys, get_fingerprint
 
 # pylint: disable=no-member
 
 LOGGER = logging.getLogger(__name__)
 
-KEY_CMD_PREFIX = 'command="'
-KEY_CMD_POSTFIX = '",restrict '
-
 
 class Command(BaseCommand):
     """
@@ -22,84 +17,33 @@ class Command(BaseCommand):
 
     help = "Get Authorized Keys from Database"
 
+    # runs on every ssh login, the checks cover the web stack
+    requires_system_checks = []
+
     def add_arguments(self, parser):
         parser.add_argument("--user", type=str)
-
-    def handle(self, *args, **options):
-
-        user = RepositoryUser.objects.get(name=options["user"])
-        LOGGER.debug(
-            "repo %s@%s has mode: %s", user, user.repository, user.repository.mode
+        parser.add_argument(
+            "--fingerprint",
+            type=str,
+            help="fingerprint of the offered key (sshd %%f), only its line is returned",
+        )
+        parser.add_argument(
+            "--key",
+            type=str,
+            help="base64 blob of the offered key (sshd %%k), only its line is returned",
         )
 
-        # import / export mode
-        if user.repository.mode in (RepositoryMode.IMPORT, RepositoryMode.EXPORT):
-
-            # add rrsync wrapper for import or export
-            for key in user.repository.ssh_keys.all():
-                LOGGER.debug(key)
-                command_options = ["/usr/bin/rrsync"]
-
-                if user.repository.mode == RepositoryMode.IMPORT:
-                    command_options.append("-wo")
-                elif user.repository.mode == RepositoryMode.EXPORT:
-                    command_options.append("-ro")
-
-                command_options.append(
-                    os.path.join(settings.BORGHIVE["REPO_PATH"], user.name)
-                )
-
-                authorized_keys_line = (
-                    KEY_CMD_PREFIX
-                    + " ".join(command_options)
-                    + KEY_CMD_POSTFIX
-                    + key.public_key
-                )
-                LOGGER.debug(authorized_keys_line)
-
-                print(authorized_keys_line)
-
-        elif user.repository.mode == RepositoryMode.BORG:
-            # add restrict to repository
-            for key in user.repository.ssh_keys.all():
-                LOGGER.debug(key)
-                command_options = ["borg serve --umask 007"]
-
-                # restrict path
-                command_options.append(
-                    f"--restrict-to-repository {user.repository.get_repo_path()}"
-                )
-
-                authorized_keys_line = (
-                    KEY_CMD_PREFIX
-                    + " ".join(command_options)
-                    + KEY_CMD_POSTFIX
-                    + key.public_key
-                )
-                LOGGER.debug(authorized_keys_line)
-
-                print(authorized_keys_line)
-
-            # add append only mode
-            for key in user.repository.append_only_keys.all():
-                LOGGER.debug(key)
-                command_options = []
-
-                command_options.append("--append-only")
-
-                # restrict path
-                command_options.append(
-                    f"--restrict-to-repository {user.repository.get_repo_path()}"
-                )
-
-                authorized_keys_line = (
-                    KEY_CMD_PREFIX
-                    + " ".join(command_options)
-                    + KEY_CMD_POSTFIX
-                    + key.public_key
-                )
-                LOGGER.debug(authorized_keys_line)
+    def handle(self, *args, **options):
 
-                print(authorized_keys_line)
-        else:
-            LOGGER.error("I dont know which mode: %s", user.repository.mode)
+        fingerprint = options.get("fingerprint")
+        if not fingerprint and options.get("key"):
+            try:
+                fingerprint = get_fingerprint(options["key"])
+            except ValueError as exc:
+                LOGGER.error(exc)
+                return
+
+        for authorized_keys_line in get_authorized_keys(
+            options["user"], fingerprint=fingerprint
+        ):
+            print(authorized_keys_line)
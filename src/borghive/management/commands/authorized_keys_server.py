@@ -0,0 +1,99 @@
+import logging
+import os
+import socketserver
+
+from django import db
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from borghive.lib.authorized_keys import get_authorized_keys
+
+# pylint: disable=no-member
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_REQUEST_LENGTH = 256
+
+
+class AuthorizedKeysRequestHandler(socketserver.StreamRequestHandler):
+    """
+    answer one lookup: the client sends the repository user name and
+    optionally the fingerprint of the offered key, separated by a space and
+    terminated by a newline, and receives the authorized_keys lines
+    """
+
+    timeout = 5
+
+    def handle(self):
+        request = (
+            self.rfile.readline(MAX_REQUEST_LENGTH).decode("utf-8", "replace").split()
+        )
+        if not request or len(request) > 2:
+            return
+        repo_user_name = request[0]
+        fingerprint = request[1] if len(request) == 2 else None
+
+        # reuses the persistent connection, reconnects if it is gone
+        db.close_old_connections()
+
+        try:
+            lines = get_authorized_keys(repo_user_name, fingerprint=fingerprint)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception(exc)
+            return
+
+        LOGGER.debug("answer %s lines for %s", len(lines), repo_user_name)
+        self.wfile.write("".join(f"{line}\n" for line in lines).encode("utf-8"))
+
+
+class AuthorizedKeysServer(socketserver.UnixStreamServer):
+    """
+    unix socket server for authorized keys lookups
+
+    requests are handled sequentially in the main thread, so a single
+    database connection is kept open and shared by all lookups.
+    """
+
+    request_queue_size = 128
+
+
+class Command(BaseCommand):
+    """
+    django management command to serve the ssh-keys from the database
+    through a unix socket for the sshd AuthorizedKeysCommand client
+    """
+
+    help = "Serve Authorized Keys from Database on a unix socket"
+
+    # runs on every ssh login, the checks cover the web stack
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        """arguments parser"""
+        parser.add_argument(
+            "--socket", type=str, default=settings.BORGHIVE["KEY_SERVER_SOCKET"]
+        )
+
+    def handle(self, *args, **options):
+        """bind the socket and serve lookups forever"""
+
+        socket_path = options["socket"]
+        socket_dir = os.path.dirname(socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            raise CommandError(f"Socket directory: {socket_dir} not found")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        # keep the connection open between lookups
+        db.connection.settings_dict["CONN_MAX_AGE"] = None
+        db.connection.settings_dict["CONN_HEALTH_CHECKS"] = True
+
+        with AuthorizedKeysServer(socket_path, AuthorizedKeysRequestHandler) as server:
+            # sshd runs the client as AuthorizedKeysCommandUser
+            os.chmod(socket_path, 0o666)
+            LOGGER.info("serving authorized keys on %s", socket_path)
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(socket_path)
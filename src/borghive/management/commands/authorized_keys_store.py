@@ -0,0 +1,29 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from borghive.lib.authorized_keys import update_authorized_keys_store
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    django management command to (re)build the precompiled authorized_keys
+    files, which sshd can read through AuthorizedKeysFile
+    """
+
+    help = "Build the precompiled authorized keys store"
+
+    def add_arguments(self, parser):
+        """arguments parser"""
+        parser.add_argument(
+            "--user",
+            type=str,
+            action="append",
+            help="only rewrite the given repository user(s), default: full rebuild",
+        )
+
+    def handle(self, *args, **options):
+        changed = update_authorized_keys_store(options["user"])
+        self.stdout.write(f"{changed} authorized keys files changed")
@@ -0,0 +1,381 @@
+import base64
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django import db
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.db.models import Max
+
+from borghive.lib.authorized_keys import (
+    get_authorized_keys,
+    get_fingerprint,
+    get_store_path,
+    update_authorized_keys_store,
+)
+from borghive.models import (
+    Repository,
+    RepositoryLocation,
+    RepositoryUser,
+    SSHPublicKey,
+)
+
+# pylint: disable=no-member,unused-argument
+
+LOGGER = logging.getLogger(__name__)
+
+BENCHMARK_PREFIX = "bm"
+BENCHMARK_OWNER = "borghive-benchmark"
+BATCH_SIZE = 500
+
+
+def percentile(values, percent):
+    """nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(percent / 100.0 * len(values)), 1)
+    return values[rank - 1]
+
+
+def count_server_connections():
+    """connections the database server accepted so far, None if unknown"""
+    if db.connection.vendor != "mysql":
+        return None
+    with db.connection.cursor() as cursor:
+        cursor.execute("SHOW GLOBAL STATUS LIKE 'Connections'")
+        return int(cursor.fetchone()[1])
+
+
+def generate_ed25519_public_key():
+    """random public key in authorized_keys format - never used to login"""
+    key_type = b"ssh-ed25519"
+    blob = (
+        len(key_type).to_bytes(4, "big")
+        + key_type
+        + (32).to_bytes(4, "big")
+        + os.urandom(32)
+    )
+    return "ssh-ed25519 " + base64.b64encode(blob).decode("ascii")
+
+
+class Command(BaseCommand):
+    """
+    django management command to benchmark the authorized keys lookup of sshd
+
+    creates synthetic repository users with keys, fires concurrent lookups
+    with the chosen strategy and reports latency percentiles and database
+    connection usage.
+    """
+
+    help = "Benchmark concurrent authorized keys lookups"
+
+    STRATEGIES = ["query", "command", "server", "store"]
+
+    def add_arguments(self, parser):
+        """arguments parser"""
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--keys-per-repo", type=int, default=3)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--strategy", choices=self.STRATEGIES, default="query")
+        parser.add_argument(
+            "--fingerprint",
+            action="store_true",
+            help="pass the fingerprint of the offered key like sshd %%f",
+        )
+        parser.add_argument(
+            "--command-settings",
+            type=str,
+            default="core.settings_sshd",
+            help="DJANGO_SETTINGS_MODULE for the command strategy",
+        )
+        parser.add_argument(
+            "--socket", type=str, default=settings.BORGHIVE["KEY_SERVER_SOCKET"]
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="keep the synthetic data"
+        )
+
+    def handle(self, *args, **options):
+        for option in ("users", "keys_per_repo", "requests", "concurrency"):
+            if options[option] < 1:
+                raise CommandError(f"--{option.replace('_', '-')} must be positive")
+
+        self.delete_benchmark_data()
+        users = self.create_benchmark_data(options["users"], options["keys_per_repo"])
+
+        try:
+            if options["strategy"] == "store":
+                update_authorized_keys_store(list(users))
+
+            lookup = getattr(self, f"lookup_{options['strategy']}")
+            names = list(users)
+            work = []
+            for _ in range(options["requests"]):
+                name = random.choice(names)
+                fingerprint = (
+                    random.choice(users[name]) if options["fingerprint"] else None
+                )
+                work.append((name, fingerprint))
+
+            self.report(
+                options, *self.run(lookup, work, options["concurrency"], options)
+            )
+        finally:
+            if not options["keep"]:
+                self.delete_benchmark_data()
+
+    def create_benchmark_data(self, num_users, keys_per_repo):
+        """bulk create repo users, repos and keys, returns name: fingerprints"""
+        owner, _ = User.objects.get_or_create(username=BENCHMARK_OWNER)
+        location, _ = RepositoryLocation.objects.get_or_create(name=BENCHMARK_OWNER)
+        first_uid = (
+            RepositoryUser.objects.aggregate(Max("uid"))["uid__max"]
+            or RepositoryUser.MIN_UID
+        ) + 1
+
+        # bulk_create skips save(), so no ldap sync, key parsing or signals
+        RepositoryUser.objects.bulk_create(
+            (
+                RepositoryUser(name=f"{BENCHMARK_PREFIX}{i:06d}", uid=first_uid + i)
+                for i in range(num_users)
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        Repository.objects.bulk_create(
+            (
+                Repository(name="repo", location=location, repo_user=user, owner=owner)
+                for user in RepositoryUser.objects.filter(uid__gte=first_uid)
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        repos = list(Repository.objects.filter(owner=owner).select_related("repo_user"))
+
+        public_keys = [
+            (f"{repo.repo_user.name}-{i}", generate_ed25519_public_key())
+            for repo in repos
+            for i in range(keys_per_repo)
+        ]
+        SSHPublicKey.objects.bulk_create(
+            (
+                SSHPublicKey(
+                    name=name,
+                    public_key=public_key,
+                    type="ed25519",
+                    bits=256,
+                    fingerprint=get_fingerprint(public_key.split()[1]),
+                    owner=owner,
+                )
+                for name, public_key in public_keys
+            ),
+            batch_size=BATCH_SIZE,
+        )
+
+        keys = defaultdict(list)
+        for key in SSHPublicKey.objects.filter(owner=owner):
+            keys[key.name.split("-")[0]].append(key)
+
+        through = Repository.ssh_keys.through
+        through.objects.bulk_create(
+            (
+                through(repository=repo, sshpublickey=key)
+                for repo in repos
+                for key in keys[repo.repo_user.name]
+            ),
+            batch_size=BATCH_SIZE,
+        )
+
+        self.stdout.write(
+            f"created {len(repos)} repository users with {keys_per_repo} keys each"
+        )
+        return {
+            name: [key.fingerprint for key in user_keys]
+            for name, user_keys in keys.items()
+        }
+
+    def delete_benchmark_data(self):
+        """remove all synthetic benchmark data"""
+        owner = User.objects.filter(username=BENCHMARK_OWNER).first()
+        if not owner:
+            return
+
+        names = list(
+            RepositoryUser.objects.filter(repository__owner=owner).values_list(
+                "name", flat=True
+            )
+        )
+        for name in names:
+            try:
+                os.unlink(get_store_path(name))
+            except FileNotFoundError:
+                pass
+
+        # delete without signals: they would remove repository data on fs and
+        # ldap users, which never existed for the synthetic users
+        # pylint: disable=protected-access
+        using = db.router.db_for_write(Repository)
+        Repository.ssh_keys.through.objects.filter(repository__owner=owner)._raw_delete(
+            using
+        )
+        Repository.objects.filter(owner=owner)._raw_delete(using)
+        RepositoryUser.objects.filter(name__in=names)._raw_delete(using)
+        SSHPublicKey.objects.filter(owner=owner)._raw_delete(using)
+        RepositoryLocation.objects.filter(name=BENCHMARK_OWNER).delete()
+        owner.delete()
+
+    def run(self, lookup, work, concurrency, options):
+        """run lookups, returns latencies in ms, wall time, errors, connections"""
+        opened = set()
+
+        def count_connection(sender, connection, **kwargs):
+            opened.add(id(connection))
+
+        def timed(item):
+            start = time.perf_counter()
+            try:
+                lookup(*item, options=options)
+                error = False
+            except CommandError:
+                # the strategy is broken, its timings would be meaningless
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                LOGGER.debug(exc)
+                error = True
+            return (time.perf_counter() - start) * 1000, error
+
+        server_connections = count_server_connections()
+        connection_created.connect(count_connection)
+        start = time.perf_counter()
+        try:
+            if concurrency == 1:
+                results = [timed(item) for item in work]
+            else:
+                results = self.run_threads(timed, work, concurrency)
+        finally:
+            connection_created.disconnect(count_connection)
+        wall_time = time.perf_counter() - start
+
+        if server_connections is not None:
+            # server wide, includes connections of other clients
+            connections = count_server_connections() - server_connections
+        elif options["strategy"] in ("query", "store"):
+            connections = len(opened)
+        else:
+            # opened by other processes, unknown without a server counter
+            connections = None
+
+        # failed lookups are counted, but their timings are no samples
+        latencies = sorted(latency for latency, error in results if not error)
+        errors = sum(error for _, error in results)
+        if not latencies:
+            raise CommandError(f"all {errors} lookups failed")
+        return latencies, wall_time, errors, connections
+
+    @staticmethod
+    def run_threads(func, work, concurrency):
+        """func of every work item in worker threads, which close their connection"""
+        pending = deque(work)
+
+        def worker():
+            results = []
+            try:
+                while True:
+                    try:
+                        item = pending.popleft()
+                    except IndexError:
+                        return results
+                    results.append(func(item))
+            finally:
+                # django does not close the connections of other threads
+                db.connection.close()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(worker) for _ in range(concurrency)]
+            return [result for future in futures for result in future.result()]
+
+    def report(self, options, latencies, wall_time, errors, connections):
+        """print benchmark summary"""
+        self.stdout.write(
+            f"strategy={options['strategy']} requests={len(latencies) + errors} "
+            f"concurrency={options['concurrency']} errors={errors}"
+        )
+        self.stdout.write(
+            f"throughput: {len(latencies) / wall_time:.1f} lookups/s "
+            f"in {wall_time:.2f}s"
+        )
+        self.stdout.write(
+            "latency ms: "
+            + " ".join(f"p{p}={percentile(latencies, p):.2f}" for p in (50, 95, 99))
+            + f" max={latencies[-1]:.2f}"
+        )
+        if connections is None:
+            self.stdout.write(
+                f"db connections opened: unknown, no connection counter for "
+                f"{db.connection.vendor}"
+            )
+        else:
+            self.stdout.write(f"db connections opened: {connections}")
+
+    # lookup strategies
+
+    def lookup_query(self, name, fingerprint, options):
+        """in process lookup, one connection per worker thread"""
+        lines = get_authorized_keys(name, fingerprint=fingerprint)
+        if not lines:
+            raise ValueError(f"no keys for {name}")
+
+    def lookup_command(self, name, fingerprint, options):
+        """fresh authorized_keys_check process, like sshd without key server"""
+        cmd = [
+            sys.executable,
+            os.path.join(settings.BASE_DIR, "manage.py"),
+            "authorized_keys_check",
+            "--user",
+            name,
+        ]
+        if fingerprint:
+            cmd += ["--fingerprint", fingerprint]
+        result = subprocess.run(
+            cmd,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE=options["command_settings"]),
+            capture_output=True,
+            check=False,
+        )
+        # every benchmark user has keys, an empty answer is a broken command
+        if result.returncode or not result.stdout:
+            raise CommandError(
+                f"authorized_keys_check failed with exit status "
+                f"{result.returncode}: {result.stderr.decode('utf-8', 'replace')}"
+            )
+
+    def lookup_server(self, name, fingerprint, options):
+        """query a running authorized_keys_server"""
+        request = f"{name} {fingerprint}" if fingerprint else name
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10)
+            sock.connect(options["socket"])
+            sock.sendall(request.encode("utf-8") + b"\n")
+            output = b""
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                output += data
+        if not output:
+            raise ValueError(f"no keys for {name}")
+
+    def lookup_store(self, name, fingerprint, options):
+        """read the precompiled authorized keys file like sshd AuthorizedKeysFile"""
+        with open(get_store_path(name), "r", encoding="utf-8") as f:
+            if not f.read():
+                raise ValueError(f"no keys for {name}")
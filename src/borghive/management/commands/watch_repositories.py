@@ -1,66 +1,671 @@
+import asyncio
 import logging
 import os
+import signal
+import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import inotify.adapters
 from django import db
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import DatabaseError, connection, transaction
 
 # used for signal activation
 import borghive.signals  # pylint: disable=unused-import
+from borghive.lib.events import RepositoryEventBuffer
+from borghive.lib.spool import EventSpool, SpoolDrainer
+from borghive.lib.reconcile import reconcile_repositories
+from borghive.lib.recording import EventRecorder, read_recording
+from borghive.lib.repo_index import RepositoryIndex
+from borghive.lib.repo_size import RepositorySizeTracker
+from borghive.lib.watches import (
+    OVERFLOW,
+    REPOSITORY_DEPTH,
+    SEGMENT_DEPTH,
+    RepositoryWatches,
+    path_depth,
+    shard_filter,
+)
 from borghive.models.repository import Repository, RepositoryEvent
+from borghive.signals import handle_repository_events
 
 LOGGER = logging.getLogger(__name__)
 
-# pylint: disable=too-many-nested-blocks
+# pylint: disable=too-many-nested-blocks,consider-using-with
 
+# restart delay of a crashed shard doubles up to this many seconds
+MAX_RESTART_DELAY = 60
+# a shard running this many seconds counts as healthy again
+RESTART_RESET = 300
 
-class Command(BaseCommand):
+
+class Command(BaseCommand):  # pylint: disable=too-many-instance-attributes
     """
     django management command to watch borg repository changes on fs with inotify
     """
 
     help = "Watch Repositories for changes"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = RepositoryEventBuffer()
+        self.index = RepositoryIndex()
+        self.drainer = None
+        self.recorder = None
+        self.sizes = None
+        self.size_writer = None
+        self.size_write = None
+        self.stopping = None
+        # asyncio: flushes requested while processing run in the database pool
+        self.defer_flush = False
+        self.flush_requested = False
+
     def add_arguments(self, parser):
         """arguments parser"""
         parser.add_argument("--repo-path", type=str, default="/repos")
+        parser.add_argument(
+            "--debounce",
+            type=float,
+            default=2.0,
+            help="drop repeated events of a repository within seconds",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=5.0,
+            help="write buffered events after seconds",
+        )
+        parser.add_argument(
+            "--flush-size",
+            type=int,
+            default=500,
+            help="write buffered events when this many are pending",
+        )
+        parser.add_argument(
+            "--index-refresh",
+            type=float,
+            default=60.0,
+            help="reload the repository index after seconds",
+        )
+        parser.add_argument(
+            "--spool",
+            type=str,
+            default=settings.BORGHIVE["WATCHER_SPOOL_PATH"],
+            help="directory spooling events for the database, empty to disable",
+        )
+        parser.add_argument(
+            "--spool-fsync-interval",
+            type=float,
+            default=1.0,
+            help="fsync spooled events at most every seconds",
+        )
+        parser.add_argument(
+            "--no-reconcile",
+            action="store_false",
+            dest="reconcile",
+            help="skip the catch up scan for events missed before the start",
+        )
+        parser.add_argument(
+            "--reconcile-workers",
+            type=int,
+            default=8,
+            help="threads scanning repositories at the start",
+        )
+        parser.add_argument(
+            "--asyncio",
+            action="store_true",
+            help="read inotify in an asyncio loop and write events in threads",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=10000,
+            help="asyncio: events queued for processing before a rescan",
+        )
+        parser.add_argument(
+            "--db-workers",
+            type=int,
+            default=1,
+            help="asyncio: threads writing events, more may reorder batches",
+        )
+        parser.add_argument(
+            "--record",
+            type=str,
+            default=None,
+            help="record the inotify events to a gzip file, .shardN per shard",
+        )
+        parser.add_argument(
+            "--replay",
+            type=str,
+            default=None,
+            help="process a recording instead of watching, a dry run by default",
+        )
+        parser.add_argument(
+            "--replay-write",
+            action="store_true",
+            help="keep the replayed events and take their follow up actions",
+        )
+        parser.add_argument(
+            "--replay-speed",
+            type=float,
+            default=1.0,
+            help="replay speed factor, 0 replays as fast as possible",
+        )
+        parser.add_argument(
+            "--track-size",
+            action="store_true",
+            default=settings.BORGHIVE["REPO_SIZE_TRACKING"],
+            help="watch segment directories and keep the repository sizes",
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=1,
+            help="split the repo users by hash into shards",
+        )
+        parser.add_argument(
+            "--shard",
+            type=int,
+            default=None,
+            help="watch only this shard, without it all shards are supervised",
+        )
 
     def get_repo_by_path(self, path):
-        """distill repo name from inotify path"""
+        """distill repo id from inotify path"""
         parts = path.split("/")
         if len(parts) < 3:  # Ensure path has at least /repos/repo_user/repo_name
             raise ValueError(f"Invalid path structure: {path}")
         repo_name = parts[-1]
         repo_user = parts[-2]
-        db.close_old_connections()
-        repo = Repository.objects.get(name=repo_name, repo_user__name=repo_user)
-        LOGGER.debug("get_repo_by_path: %s", repo)
-        return repo
+        repo_id = self.index.get(repo_user, repo_name)
+        if repo_id is None:
+            raise Repository.DoesNotExist(f"{repo_user}/{repo_name}")
+        LOGGER.debug("get_repo_by_path: %s/%s: %s", repo_user, repo_name, repo_id)
+        return repo_id
 
     def handle(self, *args, **options):
         """
-        install inotify watcher for repository directory
-        this can generate a large amount of events when there are many or large repositories.
+        install inotify watches for the repository root, the repo users and the repositories
+        segment directories of the repositories are only watched with --track-size.
         """
 
+        if options["replay"]:
+            self.replay(options)
+            return
+
         if not os.path.isdir(options["repo_path"]):
             raise CommandError(f'Repo path: {options["repo_path"]} not found')
 
-        i = inotify.adapters.InotifyTree(options["repo_path"])
+        shards, shard = self.get_shard(options)
+        if shard is None:
+            self.supervise(options)
+            return
+        user_filter = shard_filter(shards, shard)
 
-        while True and not settings.TEST_MODE:  # noqa
+        self.setup(options, shards, shard, user_filter)
+        watches = RepositoryWatches(
+            options["repo_path"],
+            user_filter=user_filter,
+            track_size=options["track_size"],
+        )
+        watches.load()
+        if options["reconcile"]:
             try:
-                for event in i.event_gen(yield_nones=False):
-                    self._process_event(event, options["repo_path"])
-            except PermissionError as exc:
-                LOGGER.debug("Ignoring PermissionError: %s", exc)
-            except borghive.models.repository.Repository.DoesNotExist as exc:
-                LOGGER.debug("Ignoring not existing repo: %s", exc)
-            except Exception as exc:  # pylint: disable=broad-except
-                LOGGER.exception(exc)
-                sys.exit(255)
+                self.reconcile(options["repo_path"], user_filter, options)
+            except DatabaseError as exc:
+                LOGGER.warning("skipping reconciliation: %s", exc)
+
+        if settings.TEST_MODE:
+            return
+        if options["asyncio"]:
+            asyncio.run(self.watch_async(watches, user_filter, options))
+            self._flush_on_exit()
+        else:
+            self.watch(watches, user_filter, options)
+
+    @staticmethod
+    def get_shard(options):
+        """(shards, shard) of this watcher, shard None to supervise all shards"""
+        shards, shard = options["shards"], options["shard"]
+        if shards < 1:
+            raise CommandError("--shards must be positive")
+        if shard is None:
+            return shards, None if shards > 1 else 0
+        if not 0 <= shard < shards:
+            raise CommandError(f"--shard must be between 0 and {shards - 1}")
+        return shards, shard
+
+    def setup(self, options, shards, shard, user_filter):
+        """event buffer and spool, repository index, recorder and size tracker"""
+        spool = None
+        if options["spool"]:
+            spool_path = options["spool"]
+            if shards > 1:
+                spool_path = os.path.join(spool_path, f"shard-{shard}")
+            spool = EventSpool(
+                spool_path, fsync_interval=options["spool_fsync_interval"]
+            )
+
+        self.buffer = RepositoryEventBuffer(
+            debounce=options["debounce"],
+            flush_interval=options["flush_interval"],
+            flush_size=options["flush_size"],
+            spool=spool,
+        )
+        if spool is not None:
+            # drains events spooled before a restart as well
+            self.drainer = SpoolDrainer(
+                spool,
+                RepositoryEventBuffer.insert,
+                follow_up=handle_repository_events,
+            )
+            self.drainer.start()
+
+        self.index = RepositoryIndex(
+            refresh_interval=options["index_refresh"], user_filter=user_filter
+        )
+        self.index.refresh_if_due()
+        LOGGER.info(
+            "shard %s/%s: repository index: %s repositories",
+            shard,
+            shards,
+            len(self.index),
+        )
+
+        if options["record"]:
+            self.recorder = EventRecorder(options["record"])
+
+        if options["track_size"]:
+            self.sizes = RepositorySizeTracker()
+
+    def watch(self, watches, user_filter, options):
+        """blocking watcher: process the events and the due periodic work"""
+
+        def stop(signum, frame):  # pylint: disable=unused-argument
+            raise SystemExit(0)
+
+        # docker stop, pod eviction and the shard supervisor send SIGTERM
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            while True:
+                try:
+                    # nones are yielded once per second without events
+                    for event in watches.event_gen(yield_nones=True):
+                        if event is not None and event[1] == [OVERFLOW]:
+                            self.rescan(watches, user_filter, options)
+                        elif event is not None:
+                            if self.recorder is not None:
+                                self.recorder.record(event)
+                            self._process_event(event, options["repo_path"])
+                        self._periodic_work()
+                except PermissionError as exc:
+                    LOGGER.debug("Ignoring PermissionError: %s", exc)
+                except borghive.models.repository.Repository.DoesNotExist as exc:
+                    LOGGER.debug("Ignoring not existing repo: %s", exc)
+                except Exception as exc:  # pylint: disable=broad-except
+                    LOGGER.exception(exc)
+                    sys.exit(255)
+        finally:
+            # a second SIGTERM must not interrupt the last flush
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            self._flush_on_exit()
+
+    def _periodic_work(self):
+        """flushes and reloads of the blocking watcher when they are due"""
+        self.buffer.flush_if_due()
+        if self.recorder is not None:
+            self.recorder.flush_if_due()
+        if self.buffer.spool is not None:
+            self.buffer.spool.sync_if_due()
+        if self.sizes is not None:
+            self._flush_sizes_if_due()
+        self.index.refresh_if_due()
+
+    def reconcile(self, repo_path, user_filter, options):
+        """write the events missed while the watcher was not running"""
+        missing = reconcile_repositories(
+            repo_path, user_filter=user_filter, workers=options["reconcile_workers"]
+        )
+        for repo_id, message in missing:
+            self.buffer.add(repo_id, message)
+        self.buffer.flush()
+
+    def rescan(self, watches, user_filter, options):
+        """catch up after the kernel dropped events"""
+        LOGGER.warning("rescanning repositories after lost events")
+        self.buffer.flush()
+        watches.load()
+        try:
+            self.reconcile(options["repo_path"], user_filter, options)
+        except DatabaseError as exc:
+            LOGGER.warning("skipping reconciliation: %s", exc)
+
+    async def watch_async(self, watches, user_filter, options):
+        """
+        asyncio watcher: the inotify fd is read whenever it is readable, the
+        events are queued and processed and the database work runs in a
+        bounded thread pool, so slow writes do not stall reading inotify.
+        a kernel queue overflow or a full queue triggers a rescan.
+        """
+        # pylint: disable=too-many-locals,too-many-statements
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=options["queue_size"])
+        overflow = asyncio.Event()
+        self.stopping = asyncio.Event()
+        executor = ThreadPoolExecutor(
+            max_workers=options["db_workers"], thread_name_prefix="watcher-db"
+        )
+        slots = asyncio.Semaphore(options["db_workers"])
+        running = set()
+        # the event loop flushes by size
+        self.buffer.flush_size = None
+        self.defer_flush = True
+
+        def read():
+            for event in watches.read_events():
+                if event[1] == [OVERFLOW]:
+                    overflow.set()
+                    continue
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    LOGGER.warning("event queue full: events were lost")
+                    overflow.set()
+
+        async def submit(func, *args):
+            """run database work in the pool, waits while all workers are busy"""
+            await slots.acquire()
+            future = loop.run_in_executor(executor, self._db_work, func, *args)
+            running.add(future)
+            future.add_done_callback(running.discard)
+            future.add_done_callback(lambda _: slots.release())
+            return future
+
+        async def flush(force=False):
+            if len(self.buffer) >= options["flush_size"] or (
+                self.buffer.flush_due() or force
+            ):
+                events = self.buffer.take()
+                if events:
+                    await submit(self._write_events, events)
+
+        async def consume():
+            while True:
+                event = await queue.get()
+                if self.recorder is not None:
+                    self.recorder.record(event)
+                key = self._index_key(event[2], options["repo_path"])
+                if key is not None and not self.index.is_cached(*key):
+                    # a new repository: look it up in the pool, not in the loop
+                    await (await submit(self.index.get, *key))
+                self._process_event(event, options["repo_path"])
+                force, self.flush_requested = self.flush_requested, False
+                await flush(force=force)
+
+        async def tick():
+            while True:
+                await asyncio.sleep(1)
+                await flush()
+                if self.recorder is not None:
+                    self.recorder.flush_if_due()
+                if self.sizes is not None and self.sizes.flush_due():
+                    await submit(self.sizes.write, *self.sizes.take())
+                await submit(self._housekeeping)
+
+        async def rescan():
+            while True:
+                await overflow.wait()
+                overflow.clear()
+                LOGGER.warning("rescanning repositories after lost events")
+                await flush(force=True)
+                if running:
+                    await asyncio.wait(set(running))
+                # the directory walk must not stall reading the inotify fd
+                await loop.run_in_executor(None, watches.load)
+                missing = await (
+                    await submit(
+                        reconcile_repositories,
+                        options["repo_path"],
+                        user_filter,
+                        options["reconcile_workers"],
+                    )
+                )
+                for repo_id, message in missing or []:
+                    self.buffer.add(repo_id, message)
+                await flush(force=True)
+
+        os.set_blocking(watches.fileno(), False)
+        loop.add_reader(watches.fileno(), read)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stopping.set)
+
+        tasks = [asyncio.create_task(coro()) for coro in (consume, tick, rescan)]
+        try:
+            await self.stopping.wait()
+        finally:
+            loop.remove_reader(watches.fileno())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not queue.empty():
+                self._process_event(queue.get_nowait(), options["repo_path"])
+            await flush(force=True)
+            if running:
+                await asyncio.wait(set(running))
+            executor.shutdown(wait=True)
+
+    def _db_work(self, func, *args):
+        """run func in a pool thread with a usable database connection"""
+        try:
+            db.close_old_connections()
+            return func(*args)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception(exc)
+            return None
+
+    def _flush_sizes_if_due(self):
+        """
+        write the tracked sizes in a thread, the scan of a repository with a
+        removed segment of unknown size would stall the event handling
+        """
+        if self.size_writer is None:
+            self.size_writer = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="watcher-size"
+            )
+        if self.size_write is not None and not self.size_write.done():
+            return
+        if self.sizes.flush_due():
+            self.size_write = self.size_writer.submit(
+                self._db_work, self.sizes.write, *self.sizes.take()
+            )
+
+    def _write_events(self, events):
+        """spool or write a batch taken from the buffer"""
+        if self.buffer.spool is not None:
+            self.buffer.spool.append(events)
+        else:
+            RepositoryEventBuffer.write(events)
+
+    def _housekeeping(self):
+        """periodic work outside of the event loop"""
+        self.index.refresh_if_due()
+        if self.buffer.spool is not None:
+            self.buffer.spool.sync_if_due()
+
+    def replay(self, options):
+        """
+        process a recorded event stream and report the throughput
+
+        a dry run inserts the events without their follow up actions, like
+        refresh tasks, and rolls them back. --replay-write keeps them.
+        """
+        offset = 0.0
+
+        def replay_clock():
+            return offset
+
+        def dry_write(events):
+            # pylint: disable=no-member
+            RepositoryEvent.objects.bulk_create(events)
+            return events
+
+        # debounce and flushes follow the recorded time, also at max speed
+        self.buffer = RepositoryEventBuffer(
+            debounce=options["debounce"],
+            flush_interval=options["flush_interval"],
+            flush_size=options["flush_size"],
+            clock=replay_clock,
+            writer=None if options["replay_write"] else dry_write,
+        )
+        self.index = RepositoryIndex(
+            refresh_interval=options["index_refresh"], clock=replay_clock
+        )
+        self.index.load()
+
+        writes = 0
+
+        def count_writes(execute, sql, params, many, context):
+            nonlocal writes
+            if sql.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+                writes += 1
+            return execute(sql, params, many, context)
+
+        events = 0
+        start = time.monotonic()
+        with transaction.atomic(), connection.execute_wrapper(count_writes):
+            for offset, event in read_recording(options["replay"]):
+                if options["replay_speed"] > 0:
+                    delay = start + offset / options["replay_speed"] - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._process_event(event, options["repo_path"])
+                self.buffer.flush_if_due()
+                events += 1
+            self.buffer.flush()
+            transaction.set_rollback(not options["replay_write"])
+        elapsed = max(time.monotonic() - start, 1e-6)
+
+        self.stdout.write(
+            f"replayed {events} events in {elapsed:.2f}s: "
+            f"{events / elapsed:.1f} events/s, "
+            f"{writes} db writes: {writes / elapsed:.1f} writes/s"
+            + ("" if options["replay_write"] else " (dry run, rolled back)")
+        )
+
+    def shard_command(self, options, shard):
+        """command line of one shard process"""
+        command = [
+            sys.executable,
+            os.path.join(settings.BASE_DIR, "manage.py"),
+            "watch_repositories",
+            "--repo-path",
+            options["repo_path"],
+            "--debounce",
+            str(options["debounce"]),
+            "--flush-interval",
+            str(options["flush_interval"]),
+            "--flush-size",
+            str(options["flush_size"]),
+            "--index-refresh",
+            str(options["index_refresh"]),
+            "--reconcile-workers",
+            str(options["reconcile_workers"]),
+            "--spool",
+            options["spool"],
+            "--spool-fsync-interval",
+            str(options["spool_fsync_interval"]),
+            "--queue-size",
+            str(options["queue_size"]),
+            "--db-workers",
+            str(options["db_workers"]),
+            "--shards",
+            str(options["shards"]),
+            "--shard",
+            str(shard),
+            "--verbosity",
+            str(options["verbosity"]),
+        ]
+        if not options["reconcile"]:
+            command.append("--no-reconcile")
+        if options["track_size"]:
+            command.append("--track-size")
+        if options["asyncio"]:
+            command.append("--asyncio")
+        if options["record"]:
+            # one recording per shard, replay them one by one
+            command += ["--record", f"{options['record']}.shard{shard}"]
+        return command
+
+    def supervise(self, options):
+        """run every shard in its own process and restart crashed shards"""
+        processes = {}
+        started = {}
+        failures = {shard: 0 for shard in range(options["shards"])}
+        restart_at = {shard: 0.0 for shard in failures}
+
+        def stop(signum, frame):  # pylint: disable=unused-argument
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+        LOGGER.info("supervising %s watcher shards", options["shards"])
+
+        try:
+            while True:
+                now = time.monotonic()
+                for shard, process in list(processes.items()):
+                    returncode = process.poll()
+                    if returncode is None:
+                        continue
+                    del processes[shard]
+                    if now - started[shard] >= RESTART_RESET:
+                        failures[shard] = 0
+                    failures[shard] += 1
+                    delay = min(2 ** failures[shard], MAX_RESTART_DELAY)
+                    restart_at[shard] = now + delay
+                    LOGGER.warning(
+                        "shard %s exited with %s, restart in %ss",
+                        shard,
+                        returncode,
+                        delay,
+                    )
+
+                for shard, start_time in restart_at.items():
+                    if shard not in processes and now >= start_time:
+                        processes[shard] = subprocess.Popen(
+                            self.shard_command(options, shard)
+                        )
+                        started[shard] = now
+                        LOGGER.info(
+                            "started shard %s: pid %s", shard, processes[shard].pid
+                        )
+
+                time.sleep(1)
+        finally:
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def _flush_on_exit(self):
+        """try to write buffered events before the watcher exits"""
+        try:
+            self.buffer.flush()
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.error("lost %s buffered events: %s", len(self.buffer.pending), exc)
+        if self.size_writer is not None:
+            self.size_writer.shutdown(wait=True)
+        if self.sizes is not None:
+            self.sizes.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.drainer is not None:
+            self.drainer.stop()
+            self.buffer.spool.close()
 
     def _process_event(self, event, repo_path):
         """Process a single inotify event."""
@@ -74,16 +679,20 @@ class Command(BaseCommand):
                 type_names,
             )
 
-            repo = self.get_repo_by_path(path)
+            if path_depth(repo_path, path) > REPOSITORY_DEPTH:
+                self._handle_segment_event(type_names, path, filename, repo_path)
+                return
+
+            repo_id = self.get_repo_by_path(path)
 
             if filename == "lock.roster":
-                self._handle_lock_event(repo, type_names)
+                self._handle_lock_event(repo_id, type_names)
             elif filename == "README" and "IN_CREATE" in type_names:
-                self._handle_create_event(repo)
+                self._handle_create_event(repo_id)
             elif filename.startswith("index.") and "IN_MOVED_TO" in type_names:
-                self._handle_update_event(repo)
+                self._handle_update_event(repo_id)
             elif "IN_DELETE_SELF" in type_names and self._is_repo_path(path, repo_path):
-                self._handle_delete_event(repo)
+                self._handle_delete_event(repo_id, path)
 
         except borghive.models.repository.Repository.DoesNotExist as exc:
             LOGGER.debug("Ignoring event for non-existing repository: %s", exc)
@@ -92,40 +701,68 @@ class Command(BaseCommand):
         except Exception as exc:  # pylint: disable=broad-except
             LOGGER.exception(exc)
 
-    def _handle_lock_event(self, repo, type_names):
+    def _handle_lock_event(self, repo_id, type_names):
         """Handle lock file events (repo open/close)."""
         if "IN_CREATE" in type_names:
-            LOGGER.info("lock created: repo open: %s", repo)
-            RepositoryEvent(
-                event_type="watcher", message="Repository open", repo=repo
-            ).save()
+            LOGGER.info("lock created: repo open: %s", repo_id)
+            self.buffer.add(repo_id, RepositoryEvent.REPO_OPEN)
         elif "IN_DELETE" in type_names:
-            LOGGER.info("lock deleted: repo close: %s", repo)
-            RepositoryEvent(
-                event_type="watcher", message="Repository closed", repo=repo
-            ).save()
+            LOGGER.info("lock deleted: repo close: %s", repo_id)
+            self.buffer.add(repo_id, RepositoryEvent.REPO_CLOSED)
 
-    def _handle_create_event(self, repo):
+    def _handle_create_event(self, repo_id):
         """Handle repo creation event."""
-        LOGGER.info("repo created: readme created - indicates repo creation: %s", repo)
-        RepositoryEvent(
-            event_type="watcher", message="Repository created", repo=repo
-        ).save()
+        LOGGER.info(
+            "repo created: readme created - indicates repo creation: %s", repo_id
+        )
+        self.buffer.add(repo_id, RepositoryEvent.REPO_CREATED)
 
-    def _handle_update_event(self, repo):
+    def _handle_update_event(self, repo_id):
         """Handle repo update event."""
-        LOGGER.info("repo updated: %s", repo)
-        RepositoryEvent(
-            event_type="watcher", message="Repository updated", repo=repo
-        ).save()
+        LOGGER.info("repo updated: %s", repo_id)
+        self.buffer.add(repo_id, RepositoryEvent.REPO_UPDATED)
 
-    def _handle_delete_event(self, repo):
+    def _handle_delete_event(self, repo_id, path):
         """Handle repo deletion event."""
-        LOGGER.info("repo deleted: %s", repo)
-        RepositoryEvent(
-            event_type="watcher", message="Repository deleted", repo=repo
-        ).save()
+        LOGGER.info("repo deleted: %s", repo_id)
+        self.buffer.add(repo_id, RepositoryEvent.REPO_DELETED)
+        # the repository may be removed from the database soon
+        if self.defer_flush:
+            self.flush_requested = True
+        else:
+            self.buffer.flush()
+        parts = path.rstrip("/").split("/")
+        self.index.discard(parts[-2], parts[-1])
+
+    def _handle_segment_event(self, type_names, path, filename, repo_path):
+        """Handle segment file events below data/ (repository size)."""
+        if self.sizes is None or not filename or "IN_ISDIR" in type_names:
+            return
+        if path_depth(repo_path, path) != SEGMENT_DEPTH:
+            return
+        parts = path.rstrip("/").split("/")
+        if parts[-2] != "data":
+            return
+        repo_dir = os.path.dirname(os.path.dirname(path.rstrip("/")))
+        repo_id = self.get_repo_by_path(repo_dir)
+        segment = os.path.join(path, filename)
+        if "IN_CLOSE_WRITE" in type_names or "IN_MOVED_TO" in type_names:
+            self.sizes.segment_written(repo_id, segment)
+        elif "IN_DELETE" in type_names or "IN_MOVED_FROM" in type_names:
+            self.sizes.segment_removed(repo_id, repo_dir, segment)
+
+    @staticmethod
+    def _index_key(path, repo_path):
+        """(repo user, repo name) get_repo_by_path looks up for an event path"""
+        if path is None:
+            return None
+        if path_depth(repo_path, path) > REPOSITORY_DEPTH:
+            path = os.path.dirname(os.path.dirname(path.rstrip("/")))
+        parts = path.split("/")
+        if len(parts) < 3:
+            return None
+        return parts[-2], parts[-1]
 
     def _is_repo_path(self, path, repo_path):
         """Check if the path is a repository path."""
-        return len(path.replace(repo_path, "").split("/")) == 2
+        return path_depth(repo_path, path) == REPOSITORY_DEPTH
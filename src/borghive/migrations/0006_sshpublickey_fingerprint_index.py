@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0005_alter_alertpreference_id_alter_notification_id_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="sshpublickey",
+            name="fingerprint",
+            field=models.CharField(db_index=True, max_length=256),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-17 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0006_sshpublickey_fingerprint_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repository",
+            name="size_bytes",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="repository",
+            name="size_verified",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.4 on 2026-10-17 15:10
+
+import configparser
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def read_fs_state(apps, schema_editor):
+    """initial state of existing repositories, kept by the refresh afterwards"""
+    Repository = apps.get_model("borghive", "Repository")
+    if not os.path.isdir(settings.BORGHIVE["REPO_PATH"]):
+        return
+    for repo in Repository.objects.select_related("repo_user"):
+        config = os.path.join(
+            settings.BORGHIVE["REPO_PATH"], repo.repo_user.name, repo.name, "config"
+        )
+        try:
+            with open(config, "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            continue
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read_string(text)
+            storage_config = {
+                option: value
+                for option, value in parser.items("repository")
+                if option != "key"
+            }
+        except configparser.Error:
+            storage_config = None
+        repo.initialized = True
+        repo.encrypted = "key =" in text
+        repo.storage_config = storage_config
+        repo.save(update_fields=["initialized", "encrypted", "storage_config"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0007_repository_size_bytes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repository",
+            name="initialized",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="repository",
+            name="encrypted",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="repository",
+            name="storage_config",
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(read_fs_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-17 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0008_repository_fs_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repositorystatistic",
+            name="chunk_count",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0009_repositorystatistic_chunk_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repository",
+            name="compact_bytes",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="repository",
+            name="compact_segments",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
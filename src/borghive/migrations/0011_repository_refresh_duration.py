@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0010_repository_compaction_debt"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repository",
+            name="refresh_duration",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.4 on 2026-10-17 19:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borghive", "0011_repository_refresh_duration"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="repositoryevent",
+            name="created",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -37,7 +37,7 @@ class SSHPublicKey(BaseModel):
 
     type = models.CharField(max_length=50)
     bits = models.IntegerField()
-    fingerprint = models.CharField(max_length=256)
+    fingerprint = models.CharField(max_length=256, db_index=True)
     comment = models.CharField(max_length=256, null=True)
 
     created = models.DateTimeField(auto_now_add=True)
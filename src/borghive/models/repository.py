@@ -1,6 +1,8 @@
+import configparser
 import datetime
 import glob
 import logging
+import math
 import os
 import subprocess
 import rules
@@ -15,6 +17,7 @@ from django.utils.timezone import make_aware
 
 import borghive.exceptions
 import borghive.lib.rules
+from borghive.lib.borg_index import get_chunk_count, get_compaction_debt
 from borghive.lib.user import generate_userid
 from borghive.models.base import BaseModel
 from borghive.models.ldap import RepositoryLdapUser
@@ -25,6 +28,25 @@ from .key import SSHPublicKey
 LOGGER = logging.getLogger(__name__)
 
 
+def parse_storage_config(text):
+    """
+    repository section of a borg config file
+
+    the encrypted key of repokey repositories is left out.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read_string(text)
+    except configparser.Error as exc:
+        LOGGER.warning("invalid repository config: %s", exc)
+        return None
+    if not parser.has_section("repository"):
+        return None
+    return {
+        option: value for option, value in parser.items("repository") if option != "key"
+    }
+
+
 class RepositoryLocation(BaseModel):
     """
     repository location model
@@ -117,7 +139,7 @@ class RepositoryMode:
     CHOICES = [(BORG, "Borg"), (IMPORT, "Import"), (EXPORT, "Export")]
 
 
-class Repository(BaseModel):
+class Repository(BaseModel):  # pylint: disable=too-many-instance-attributes
     """
     repository model
 
@@ -150,10 +172,28 @@ class Repository(BaseModel):
     last_updated = models.DateTimeField(null=True, blank=True)
     last_access = models.DateTimeField(null=True, blank=True)
 
+    # bytes in data/, kept by the watcher with --track-size
+    size_bytes = models.BigIntegerField(null=True, blank=True)
+    size_verified = models.DateTimeField(null=True, blank=True)
+
+    # filesystem state, kept by the refresh and the watcher - views must not
+    # touch the repository directory
+    initialized = models.BooleanField(default=False)
+    encrypted = models.BooleanField(default=False)
+    storage_config = models.JSONField(null=True, blank=True)
+    # freeable by borg compact, from the hints file
+    compact_bytes = models.BigIntegerField(null=True, blank=True)
+    compact_segments = models.IntegerField(null=True, blank=True)
+    # seconds of the last refresh scan, used to schedule the fleet refresh
+    refresh_duration = models.FloatField(null=True, blank=True)
+
     alert_after_days = models.IntegerField(null=True, blank=True)  # days
 
     objects = OwnerOrGroupManager()
 
+    # fields the authorized keys of the repo user depend on
+    AUTHORIZED_KEYS_FIELDS = ("name", "mode", "repo_user_id")
+
     # Define DoesNotExist to make pylint recognize it
     class DoesNotExist(ObjectDoesNotExist):
         pass
@@ -162,6 +202,33 @@ class Repository(BaseModel):
         """representation"""
         return f"Repository: {self.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """remember the loaded authorized keys fields"""
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_keys_fields = {
+            name: value
+            for name, value in zip(field_names, values)
+            if name in cls.AUTHORIZED_KEYS_FIELDS
+        }
+        return instance
+
+    def get_changed_keys_fields(self):
+        """authorized keys fields changed since loading, with their loaded value"""
+        loaded = getattr(self, "loaded_keys_fields", {})
+        return {
+            name: value
+            for name, value in loaded.items()
+            if getattr(self, name) != value
+        }
+
+    def reset_keys_fields(self):
+        """the current authorized keys fields are saved"""
+        # pylint: disable=attribute-defined-outside-init
+        self.loaded_keys_fields = {
+            name: getattr(self, name) for name in self.AUTHORIZED_KEYS_FIELDS
+        }
+
     def get_repo_path(self):
         """
         path to repo on fs
@@ -191,6 +258,16 @@ class Repository(BaseModel):
                 return "key =" in f.read()
         return False
 
+    def get_storage_config(self):
+        """
+        repository section of the borg config file
+        """
+        if self.is_created():
+            config = os.path.join(self.get_repo_path(), "config")
+            with open(config, "r") as f:  # pylint: disable=unspecified-encoding
+                return parse_storage_config(f.read())
+        return None
+
     def get_last_access_by_fs(self):
         """
         get last repository access
@@ -220,7 +297,10 @@ class Repository(BaseModel):
         get repository size in megabytes
         estimated on how much filespace is occupied
         heavy operation on fs!
+        uses the size tracked by the watcher when size tracking is enabled
         """
+        if settings.BORGHIVE["REPO_SIZE_TRACKING"] and self.size_bytes is not None:
+            return math.ceil(self.size_bytes / (1024 * 1024))
         if self.is_created():
             data_path = os.path.join(self.get_repo_path(), "data")
             return (
@@ -245,15 +325,26 @@ class Repository(BaseModel):
             # update acess infos
             self.last_updated = self.get_last_updated_by_fs()
             self.last_access = self.get_last_access_by_fs()
+            self.initialized = True
+            self.encrypted = self.is_encrypted()
+            self.storage_config = self.get_storage_config()
+            self.compact_bytes, self.compact_segments = get_compaction_debt(
+                self.get_repo_path()
+            ) or (None, None)
             self.save()
 
             # create statistic
             statistic = RepositoryStatistic(
-                repo_size=self.get_repo_size(), repo_size_unit="MB"
+                repo_size=self.get_repo_size(),
+                repo_size_unit="MB",
+                chunk_count=get_chunk_count(self.get_repo_path()),
             )
             statistic.repo = self
             statistic.save()
         else:
+            if self.initialized:
+                self.initialized = False
+                self.save(update_fields=["initialized"])
             raise borghive.exceptions.RepositoryNotCreated()
 
     def should_alert(self):
@@ -362,6 +453,8 @@ class RepositoryStatistic(BaseModel):
 
     repo_size = models.IntegerField()  # mega bytes
     repo_size_unit = models.CharField(max_length=3)
+    # entries in the repository index, grows with unique (deduplicated) data
+    chunk_count = models.BigIntegerField(null=True, blank=True)
     repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -384,6 +477,16 @@ class RepositoryEvent(BaseModel):
         (NOTIFY, "notification"),
     ]
 
+    # watcher messages
+    REPO_OPEN = "Repository open"
+    REPO_CLOSED = "Repository closed"
+    REPO_CREATED = "Repository created"
+    REPO_UPDATED = "Repository updated"
+    REPO_DELETED = "Repository deleted"
+
+    # set when the event happened, the watcher writes events later in bulk
+    # and after a database outage from its spool
+    created = models.DateTimeField(default=timezone.now)
     event_type = models.CharField(max_length=20, choices=EVENT_TYPES)
     message = models.TextField(max_length=200)
     repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
@@ -1,23 +1,43 @@
 import logging
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 
 import borghive.tasks
+from borghive.lib.authorized_keys import get_repo_user_names_for_key
+from borghive.lib.routing import get_location_queue, route_options
 from borghive.models import (
     AlertPreference,
     Repository,
     RepositoryEvent,
     RepositoryUser,
     RepositoryLdapUser,
+    SSHPublicKey,
 )
 
 LOGGER = logging.getLogger(__name__)
 
+# repository update_fields the authorized keys depend on
+KEYS_UPDATE_FIELDS = {"name", "mode", "repo_user", "repo_user_id"}
+
 # pylint: disable=unused-argument,no-member
 
 
+def schedule_authorized_keys_update(repo_user_names):
+    """rewrite the authorized keys store of the given repo users after commit"""
+    repo_user_names = list(repo_user_names)
+    if not repo_user_names:
+        return
+    transaction.on_commit(
+        lambda: borghive.tasks.update_authorized_keys.delay(
+            repo_user_names=repo_user_names
+        )
+    )
+
+
 @receiver(post_save, sender=get_user_model())
 def create_user_profile(sender, instance, created, **kwargs):
     """create alert preference when a user is created"""
@@ -48,7 +68,99 @@ def repository_user_deleted(sender, instance, **kwargs):
 def repository_deleted(sender, instance, **kwargs):
     """delete repository data on filesystem when repository is deleted"""
     LOGGER.debug("repository_deleted: %s, %s, %s", sender, instance, kwargs)
-    borghive.tasks.repository_delete.delay(instance.get_repo_path())
+    borghive.tasks.repository_delete.apply_async(
+        args=[instance.get_repo_path()],
+        **route_options(get_location_queue(instance.location_id)),
+    )
+    if settings.BORGHIVE["AUTHORIZED_KEYS_STORE"]:
+        schedule_authorized_keys_update([instance.repo_user.name])
+
+
+@receiver(post_save, sender=Repository)
+def repository_saved(sender, instance, created, update_fields=None, **kwargs):
+    """mode, path or repo user of a repository changed - update authorized keys"""
+    if update_fields is not None and not set(update_fields) & KEYS_UPDATE_FIELDS:
+        return
+    changed = instance.get_changed_keys_fields()
+    instance.reset_keys_fields()
+    if not settings.BORGHIVE["AUTHORIZED_KEYS_STORE"] or not (created or changed):
+        return
+
+    repo_user_names = [instance.repo_user.name]
+    if "repo_user_id" in changed:
+        # the previous repo user lost the repository
+        repo_user_names += RepositoryUser.objects.filter(
+            id=changed["repo_user_id"]
+        ).values_list("name", flat=True)
+    schedule_authorized_keys_update(repo_user_names)
+
+
+@receiver(m2m_changed, sender=Repository.ssh_keys.through)
+@receiver(m2m_changed, sender=Repository.append_only_keys.through)
+def repository_keys_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """keys added to or removed from a repository - update authorized keys"""
+    if not settings.BORGHIVE["AUTHORIZED_KEYS_STORE"]:
+        return
+
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            schedule_authorized_keys_update([instance.repo_user.name])
+    elif action == "pre_clear":
+        # the affected repositories are unknown after the clear
+        schedule_authorized_keys_update(get_repo_user_names_for_key(instance))
+    elif action in ("post_add", "post_remove"):
+        schedule_authorized_keys_update(
+            RepositoryUser.objects.filter(repository__id__in=pk_set).values_list(
+                "name", flat=True
+            )
+        )
+
+
+@receiver(post_save, sender=SSHPublicKey)
+def ssh_public_key_saved(sender, instance, created, **kwargs):
+    """public key changed - update authorized keys of all repos using it"""
+    if settings.BORGHIVE["AUTHORIZED_KEYS_STORE"] and not created:
+        schedule_authorized_keys_update(get_repo_user_names_for_key(instance))
+
+
+@receiver(pre_delete, sender=SSHPublicKey)
+def ssh_public_key_deleted(sender, instance, **kwargs):
+    """public key deleted - update authorized keys of all repos using it"""
+    if settings.BORGHIVE["AUTHORIZED_KEYS_STORE"]:
+        schedule_authorized_keys_update(get_repo_user_names_for_key(instance))
+
+
+def handle_repository_events(events):
+    """
+    filter new repository events and take actions
+
+    called for single saved events and for events written with bulk_create
+    by the watcher, which does not emit post_save. the statistic of an
+    updated repository is refreshed once a burst of updates has settled.
+    """
+
+    # shaky: repository updated / archive created
+    updated_repo_ids = {
+        event.repo_id
+        for event in events
+        if event.event_type == RepositoryEvent.WATCHER
+        and RepositoryEvent.REPO_UPDATED in event.message
+    }
+    for repo_id in updated_repo_ids:
+        borghive.tasks.schedule_repo_refresh(repo_id)
+
+    # deleted repositories are not initialized anymore, the refresh after the
+    # next index write marks them initialized again
+    deleted_repo_ids = {
+        event.repo_id
+        for event in events
+        if event.event_type == RepositoryEvent.WATCHER
+        and event.message == RepositoryEvent.REPO_DELETED
+    }
+    if deleted_repo_ids:
+        Repository.objects.filter(id__in=deleted_repo_ids, initialized=True).update(
+            initialized=False
+        )
 
 
 @receiver(post_save, sender=RepositoryEvent)
@@ -62,10 +174,5 @@ def handle_repository_event(sender, instance, created, **kwargs):
     LOGGER.debug(instance.event_type)
     LOGGER.debug(instance.message)
 
-    # shaky: repository updated / archive created
-    if (
-        created
-        and instance.event_type == RepositoryEvent.WATCHER
-        and "Repository updated" in instance.message
-    ):
-        borghive.tasks.create_repo_statistic.delay(repo_id=instance.repo.id)
+    if created:
+        handle_repository_events([instance])
@@ -1,2 +1,3 @@
 from .alert import *
+from .keys import *
 from .repo import *
@@ -1,4 +1,5 @@
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.utils import timezone
 
 from borghive.models import EmailNotification, Repository, RepositoryEvent
@@ -8,12 +9,22 @@ LOGGER = get_task_logger(__name__)
 
 
 @app.task
-def alert_guard_tour(repo_id=None):
+def alert_guard_tour(repo_id=None, repo_ids=None, force=False):
     """
     check if an owner should be notified about a repository
+
+    with staggering the repositories are checked by the staggered sweep,
+    the fleet-wide tour only runs when forced.
     """
     if repo_id:
         repos = Repository.objects.filter(id=repo_id, alert_after_days__isnull=False)
+    elif repo_ids is not None:
+        repos = Repository.objects.filter(
+            id__in=repo_ids, alert_after_days__isnull=False
+        )
+    elif settings.BORGHIVE["STAGGER"] and not force:
+        LOGGER.debug("alert checks are staggered, skipping the guard tour")
+        return
     else:
         repos = Repository.objects.filter(alert_after_days__isnull=False)
 
@@ -0,0 +1,14 @@
+from celery.utils.log import get_task_logger
+
+from borghive.lib.authorized_keys import update_authorized_keys_store
+from core.celery import app
+
+LOGGER = get_task_logger(__name__)
+
+
+@app.task
+def update_authorized_keys(repo_user_names=None):
+    """update the precompiled authorized keys store for some or all repo users"""
+    changed = update_authorized_keys_store(repo_user_names)
+    LOGGER.info("authorized keys store: %s files changed", changed)
+    return changed
@@ -1,25 +1,217 @@
+import datetime
 import subprocess
 import shutil
+import time
 
+from celery import chord
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 
+from borghive.lib.refresh_schedule import plan_refresh
+from borghive.lib.repo_size import verify_repository_sizes
+from borghive.lib.routing import (
+    get_repo_queue,
+    group_by_queue,
+    location_queue,
+    route_options,
+)
+from borghive.lib.scanner import refresh_repositories
+from borghive.lib.stagger import (
+    DAY,
+    HOUR,
+    alert_offset,
+    get_intervals,
+    is_due,
+    refresh_offset,
+)
 from borghive.models import Repository
+from borghive.tasks.alert import alert_guard_tour
 from core.celery import app
 
 LOGGER = get_task_logger(__name__)
 
+# cache keys of the debounced refresh
+REFRESH_SCHEDULED = "borghive:refresh:scheduled:{}"
+REFRESH_LAST_EVENT = "borghive:refresh:last-event:{}"
+STAGGER_LAST_SWEEP = "borghive:stagger:last-sweep"
+
+# seconds between staggered sweeps, used when the last sweep is unknown
+STAGGER_TICK = 300
+
+
+def schedule_repo_refresh(repo_id):
+    """
+    refresh a repository once a burst of update events has settled
+
+    every event moves the refresh to REFRESH_DEBOUNCE seconds after it, only
+    the first event of a burst enqueues a task - a marker in the cache
+    deduplicates the others. the refresh runs on the workers of the
+    repository location.
+    """
+    window = settings.BORGHIVE["REFRESH_DEBOUNCE"]
+    if not window:
+        create_repo_statistic.apply_async(
+            kwargs={"repo_id": repo_id}, **route_options(get_repo_queue(repo_id))
+        )
+        return
+    try:
+        cache.set(REFRESH_LAST_EVENT.format(repo_id), time.time(), timeout=window * 4)
+        # the marker expires if the task got lost
+        if not cache.add(REFRESH_SCHEDULED.format(repo_id), 1, timeout=window * 4):
+            return
+    except Exception as exc:  # pylint: disable=broad-except
+        LOGGER.warning("refresh not debounced, cache unavailable: %s", exc)
+        create_repo_statistic.apply_async(
+            kwargs={"repo_id": repo_id}, **route_options(get_repo_queue(repo_id))
+        )
+        return
+    debounced_repo_refresh.apply_async(
+        args=[repo_id], countdown=window, **route_options(get_repo_queue(repo_id))
+    )
+
+
+@app.task
+def debounced_repo_refresh(repo_id):
+    """refresh a repository, or wait longer if it was updated meanwhile"""
+    window = settings.BORGHIVE["REFRESH_DEBOUNCE"]
+    last_event = cache.get(REFRESH_LAST_EVENT.format(repo_id)) or 0
+    quiet = time.time() - last_event
+    if quiet < window:
+        cache.touch(REFRESH_SCHEDULED.format(repo_id), timeout=window * 4)
+        debounced_repo_refresh.apply_async(
+            args=[repo_id],
+            countdown=window - quiet,
+            **route_options(get_repo_queue(repo_id))
+        )
+        return
+    # later events schedule a new refresh
+    cache.delete(REFRESH_SCHEDULED.format(repo_id))
+    create_repo_statistic(repo_id=repo_id)
+
 
 @app.task
-def create_repo_statistic(repo_id=None):
+def create_repo_statistic(repo_id=None, force=False):
     """create repository statistic for one or multiple repos - async"""
     if repo_id:
         repos = Repository.objects.filter(id=repo_id)
-    else:
-        repos = Repository.objects.all()
+        LOGGER.info("refresh repo statistics for: %s", repos)
+        for repo in repos:
+            repo.refresh()
+        return None
+
+    if settings.BORGHIVE["STAGGER"] and not force:
+        LOGGER.info("refreshes are staggered, skipping the fleet refresh")
+        return None
+
+    # all repositories: chunks of similar cost refreshed in parallel by the
+    # workers of each location, the most expensive first
+    repos = Repository.objects.values_list(
+        "location__name", "id", "size_bytes", "refresh_duration"
+    )
+    chunks, expected = [], 0
+    for queue, location_repos in group_by_queue(
+        (repo[0], repo[1:]) for repo in repos
+    ).items():
+        location_chunks, location_expected = plan_refresh(
+            location_repos,
+            chunk_size=settings.BORGHIVE["REFRESH_CHUNK_SIZE"],
+            workers=settings.BORGHIVE["REFRESH_WORKERS"],
+            scan_workers=settings.BORGHIVE["SCAN_WORKERS"],
+        )
+        chunks += [(queue, chunk) for chunk in location_chunks]
+        expected = max(expected, location_expected)
+    LOGGER.info(
+        "refresh %s repositories in %s chunks, expected to complete in %.0fs",
+        sum(len(chunk) for _, chunk in chunks),
+        len(chunks),
+        expected,
+    )
+    if chunks:
+        chord(
+            refresh_repo_chunk.s(chunk).set(**route_options(queue))
+            for queue, chunk in chunks
+        )(refresh_summary.s(time.time(), expected))
+    return expected
+
 
-    LOGGER.info("refresh repo statistics for: %s", repos)
-    for repo in repos:
-        repo.refresh()
+@app.task
+def staggered_sweep():
+    """
+    refresh and alert check the repositories whose slot passed since the
+    last sweep - runs every few minutes, does nothing without staggering
+    """
+    if not settings.BORGHIVE["STAGGER"]:
+        return None
+    now = timezone.now()
+    since = cache.get(STAGGER_LAST_SWEEP)
+    if since is None or now - since > datetime.timedelta(seconds=DAY):
+        since = now - datetime.timedelta(seconds=STAGGER_TICK)
+    cache.set(STAGGER_LAST_SWEEP, now, timeout=None)
+
+    intervals = get_intervals()
+    refresh_ids, alert_ids = [], []
+    for repo_id, location in Repository.objects.values_list("id", "location__name"):
+        if is_due(refresh_offset(repo_id, intervals), DAY, since, now):
+            refresh_ids.append((location, repo_id))
+        if is_due(alert_offset(repo_id), HOUR, since, now):
+            alert_ids.append(repo_id)
+
+    LOGGER.info(
+        "staggered sweep: %s refreshes, %s alert checks",
+        len(refresh_ids),
+        len(alert_ids),
+    )
+    for queue, repo_ids in group_by_queue(refresh_ids).items():
+        refresh_repo_chunk.apply_async(args=[repo_ids], **route_options(queue))
+    if alert_ids:
+        alert_guard_tour.delay(repo_ids=alert_ids)
+    return len(refresh_ids), len(alert_ids)
+
+
+@app.task
+def refresh_repo_chunk(repo_ids):
+    """refresh a chunk of repositories with one scan - part of the fleet refresh"""
+    started = time.monotonic()
+    try:
+        # keep the planned order, the most expensive repositories first
+        repos = Repository.objects.select_related("repo_user").in_bulk(repo_ids)
+        refreshed, failed = map(
+            len,
+            refresh_repositories(
+                [repos[repo_id] for repo_id in repo_ids if repo_id in repos]
+            ),
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        # the summary runs only if every chunk returns
+        LOGGER.exception("refresh of %s repositories failed: %s", len(repo_ids), exc)
+        refreshed, failed = 0, len(repo_ids)
+    return {
+        "repos": len(repo_ids),
+        "refreshed": refreshed,
+        "failed": failed,
+        "duration": time.monotonic() - started,
+    }
+
+
+@app.task
+def refresh_summary(results, started, expected=None):
+    """log the result of the fleet refresh"""
+    summary = {
+        "chunks": len(results),
+        "repos": sum(result["repos"] for result in results),
+        "refreshed": sum(result["refreshed"] for result in results),
+        "failed": sum(result["failed"] for result in results),
+        "slowest_chunk": max((result["duration"] for result in results), default=0),
+        "duration": time.time() - started,
+        "expected": expected,
+    }
+    if summary["failed"]:
+        LOGGER.warning("refresh of repositories finished with failures: %s", summary)
+    else:
+        LOGGER.info("refresh of repositories finished: %s", summary)
+    return summary
 
 
 @app.task
@@ -33,6 +225,35 @@ def get_repo_size(repo_id):
     )
 
 
+@app.task
+def verify_repo_sizes(location_id=None, force=False):
+    """
+    full scan of all repository sizes - corrects the sizes tracked by the watcher
+
+    without size tracking the daily refresh scans the sizes, the scan only
+    runs when forced.
+    """
+    if not settings.BORGHIVE["REPO_SIZE_TRACKING"] and not force:
+        LOGGER.debug("repository sizes are not tracked, skipping the verification")
+        return
+    repos = Repository.objects.select_related("repo_user")
+    if location_id is not None:
+        repos = repos.filter(location_id=location_id)
+    elif settings.BORGHIVE["LOCATION_ROUTING"]:
+        # every location verifies its repositories on its storage node
+        for location, name in repos.values_list(
+            "location_id", "location__name"
+        ).distinct():
+            verify_repo_sizes.apply_async(
+                kwargs={"location_id": location, "force": force},
+                queue=location_queue(name),
+            )
+        return
+    repos = list(repos)
+    drifted = verify_repository_sizes(repos)
+    LOGGER.info("verified %s repository sizes, %s drifted", len(repos), len(drifted))
+
+
 @app.task
 def repository_delete(repo_path):
     """delete repository on filesystem"""
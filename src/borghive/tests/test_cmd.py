@@ -3,11 +3,22 @@ import unittest
 from io import StringIO
 import sys
 import os
+import socket
+import subprocess
+import tempfile
+import time
+from unittest import mock
 
+from django.conf import settings
 from django.test import TestCase
 
 from django.core import management
 from borghive.management.commands.authorized_keys_check import Command as ACommand
+from borghive.management.commands.authorized_keys_server import (
+    AuthorizedKeysRequestHandler,
+)
+from borghive.lib.authorized_keys import get_authorized_keys
+from borghive.models import Repository, RepositoryUser, SSHPublicKey
 
 
 class CommandTest(TestCase):
@@ -19,6 +30,57 @@ class CommandTest(TestCase):
         "testing/repositories.yaml",
     ]
 
+    def test_sshd_commands(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # core.settings_sshd with an empty database of its own
+            with open(os.path.join(temp_dir, "sshd_test_settings.py"), "w") as f:
+                f.write(
+                    "from core.settings_sshd import *\n"
+                    "DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', "
+                    f"'NAME': {os.path.join(temp_dir, 'db.sqlite3')!r}}}}}\n"
+                )
+            env = dict(
+                os.environ,
+                DJANGO_SETTINGS_MODULE="sshd_test_settings",
+                PYTHONPATH=os.pathsep.join([temp_dir, str(settings.BASE_DIR)]),
+            )
+            manage = [sys.executable, os.path.join(settings.BASE_DIR, "manage.py")]
+            subprocess.run(
+                manage + ["migrate", "--verbosity", "0"],
+                env=env,
+                capture_output=True,
+                check=True,
+            )
+
+            result = subprocess.run(
+                manage + ["authorized_keys_check", "--user", "nobody"],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            self.assertEqual(result.stdout, "")
+
+            socket_path = os.path.join(temp_dir, "authorized_keys.sock")
+            with subprocess.Popen(
+                manage + ["authorized_keys_server", "--socket", socket_path],
+                env=env,
+                stderr=subprocess.PIPE,
+            ) as server:
+                try:
+                    for _ in range(100):
+                        if os.path.exists(socket_path) or server.poll() is not None:
+                            break
+                        time.sleep(0.1)
+                    self.assertIsNone(server.poll(), server.stderr.read())
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                        sock.settimeout(10)
+                        sock.connect(socket_path)
+                        sock.sendall(b"nobody\n")
+                        self.assertEqual(sock.recv(65536), b"")
+                finally:
+                    server.terminate()
+
     def test_run_authorized_keys_check(self):
         out = StringIO()
         sys.stdout = out
@@ -53,6 +115,255 @@ class CommandTest(TestCase):
         cmd = ACommand()
         cmd.handle(user="abulfj66")
 
+    def _query_authorized_keys_server(self, request):
+        server_end, client_end = socket.socketpair()
+        with server_end, client_end:
+            client_end.sendall(request)
+            with mock.patch("django.db.close_old_connections"):
+                AuthorizedKeysRequestHandler(server_end, "", None)
+            server_end.close()
+            return client_end.makefile("rb").read().decode("utf-8")
+
+    def test_authorized_keys_server(self):
+        response = self._query_authorized_keys_server(b"abulfj66\n")
+        self.assertEqual(response.count("\n"), 3)
+        self.assertTrue("--restrict-to-repository" in response)
+        self.assertTrue("--append-only" in response)
+
+    def test_authorized_keys_server_unknown_user(self):
+        response = self._query_authorized_keys_server(b"unknown\n")
+        self.assertEqual(response, "")
+
+    def test_authorized_keys_single_query(self):
+        with self.assertNumQueries(1):
+            lines = get_authorized_keys("abulfj66")
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('command="borg serve --umask 007'))
+        self.assertTrue(lines[2].startswith('command="--append-only'))
+        repo_path = os.path.join(settings.BORGHIVE["REPO_PATH"], "abulfj66", "test")
+        self.assertTrue(f"--restrict-to-repository {repo_path}" in lines[2])
+
+        with self.assertNumQueries(1):
+            lines = get_authorized_keys(
+                "abulfj66",
+                fingerprint="SHA256:rSMKUgIOn09GCnjmK7qBxmPzSSIGtK7Z4hf9sczbTKs",
+            )
+        self.assertEqual(len(lines), 1)
+
+        with self.assertNumQueries(1):
+            lines = get_authorized_keys("7w9747gn")
+        self.assertEqual(len(lines), 1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get_authorized_keys("unknown"), [])
+
+    def test_run_authorized_keys_check_fingerprint(self):
+        out = StringIO()
+        sys.stdout = out
+        management.call_command(
+            "authorized_keys_check",
+            "--user",
+            "abulfj66",
+            "--fingerprint",
+            "SHA256:Wh1CCbBcB+TDwv16rdu9IGbfAXD/KLyUvUaDTmy4IvU",
+            stdout=out,
+        )
+        self.assertEqual(out.getvalue().count("\n"), 1)
+        self.assertTrue("--append-only" in out.getvalue())
+
+    def test_run_authorized_keys_check_key(self):
+        out = StringIO()
+        sys.stdout = out
+        management.call_command(
+            "authorized_keys_check",
+            "--user",
+            "abulfj66",
+            "--key",
+            "AAAAC3NzaC1lZDI1NTE5AAAAIJy2GMJLrWk7AiHWRA8crkfxcbqGfx8mCR4/ox3C9pZe",
+            stdout=out,
+        )
+        self.assertEqual(out.getvalue().count("\n"), 1)
+
+    def test_authorized_keys_server_fingerprint(self):
+        response = self._query_authorized_keys_server(
+            b"abulfj66 SHA256:rSMKUgIOn09GCnjmK7qBxmPzSSIGtK7Z4hf9sczbTKs\n"
+        )
+        self.assertEqual(response.count("\n"), 1)
+        self.assertTrue("borg serve" in response)
+
+        response = self._query_authorized_keys_server(b"abulfj66 SHA256:unknown\n")
+        self.assertEqual(response, "")
+
+    def test_authorized_keys_store(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with mock.patch.dict(
+                settings.BORGHIVE, {"AUTHORIZED_KEYS_STORE_PATH": temp_dir}
+            ):
+                open(os.path.join(temp_dir, "stale"), "w").close()
+                out = StringIO()
+                management.call_command("authorized_keys_store", stdout=out)
+                self.assertEqual(
+                    sorted(os.listdir(temp_dir)),
+                    ["6w9646gn", "7w9747gn", "8w9848gn", "abulfj66"],
+                )
+                with open(os.path.join(temp_dir, "abulfj66")) as f:
+                    self.assertEqual(f.read().count("\n"), 3)
+
+                # nothing changed
+                out = StringIO()
+                management.call_command(
+                    "authorized_keys_store", "--user", "abulfj66", stdout=out
+                )
+                self.assertTrue(out.getvalue().startswith("0 "))
+
+    def test_authorized_keys_store_signals(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with mock.patch.dict(
+                settings.BORGHIVE,
+                {"AUTHORIZED_KEYS_STORE": True, "AUTHORIZED_KEYS_STORE_PATH": temp_dir},
+            ):
+                repo = Repository.objects.get(name="test")
+                with self.captureOnCommitCallbacks(execute=True):
+                    repo.append_only_keys.clear()
+                with open(os.path.join(temp_dir, "abulfj66")) as f:
+                    self.assertEqual(f.read().count("\n"), 2)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    SSHPublicKey.objects.get(pk=1).delete()
+                with open(os.path.join(temp_dir, "abulfj66")) as f:
+                    self.assertEqual(f.read().count("\n"), 1)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    repo.delete()
+                self.assertFalse(os.path.exists(os.path.join(temp_dir, "abulfj66")))
+
+    def test_benchmark_authorized_keys(self):
+        num_users = RepositoryUser.objects.count()
+        out = StringIO()
+        management.call_command(
+            "benchmark_authorized_keys",
+            "--users",
+            "5",
+            "--requests",
+            "20",
+            "--concurrency",
+            "1",
+            "--fingerprint",
+            stdout=out,
+        )
+        self.assertTrue("requests=20 concurrency=1 errors=0" in out.getvalue())
+        self.assertTrue("p95=" in out.getvalue())
+        self.assertTrue("db connections opened: 0" in out.getvalue())
+        self.assertEqual(RepositoryUser.objects.count(), num_users)
+
+    def test_benchmark_broken_command(self):
+        num_users = RepositoryUser.objects.count()
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                "benchmark_authorized_keys",
+                "--users",
+                "1",
+                "--requests",
+                "1",
+                "--concurrency",
+                "1",
+                "--strategy",
+                "command",
+                "--command-settings",
+                "core.settings_missing",
+                stdout=StringIO(),
+            )
+        self.assertEqual(RepositoryUser.objects.count(), num_users)
+
+    def test_sshd_settings_import_time(self):
+        import core.settings_sshd
+
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import django; django.setup(); "
+                "import borghive.management.commands.authorized_keys_check",
+            ],
+            cwd=settings.BASE_DIR,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE="core.settings_sshd"),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        total_import_time = 0
+        modules = set()
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_time, _, name = line[len("import time:") :].split("|")
+            total_import_time += int(self_time)
+            modules.add(name.strip())
+
+        for forbidden in core.settings_sshd.SSHD_FORBIDDEN_IMPORTS:
+            self.assertFalse(
+                any(
+                    module == forbidden or module.startswith(f"{forbidden}.")
+                    for module in modules
+                ),
+                f"{forbidden} imported by sshd commands",
+            )
+        self.assertLess(total_import_time, core.settings_sshd.SSHD_IMPORT_TIME_BUDGET)
+
+    def test_sshd_commands(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # core.settings_sshd with an empty database of its own
+            with open(os.path.join(temp_dir, "sshd_test_settings.py"), "w") as f:
+                f.write(
+                    "from core.settings_sshd import *\n"
+                    "DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', "
+                    f"'NAME': {os.path.join(temp_dir, 'db.sqlite3')!r}}}}}\n"
+                )
+            env = dict(
+                os.environ,
+                DJANGO_SETTINGS_MODULE="sshd_test_settings",
+                PYTHONPATH=os.pathsep.join([temp_dir, str(settings.BASE_DIR)]),
+            )
+            manage = [sys.executable, os.path.join(settings.BASE_DIR, "manage.py")]
+            subprocess.run(
+                manage + ["migrate", "--verbosity", "0"],
+                env=env,
+                capture_output=True,
+                check=True,
+            )
+
+            result = subprocess.run(
+                manage + ["authorized_keys_check", "--user", "nobody"],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            self.assertEqual(result.stdout, "")
+
+            socket_path = os.path.join(temp_dir, "authorized_keys.sock")
+            with subprocess.Popen(
+                manage + ["authorized_keys_server", "--socket", socket_path],
+                env=env,
+                stderr=subprocess.PIPE,
+            ) as server:
+                try:
+                    for _ in range(100):
+                        if os.path.exists(socket_path) or server.poll() is not None:
+                            break
+                        time.sleep(0.1)
+                    self.assertIsNone(server.poll(), server.stderr.read())
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                        sock.settimeout(10)
+                        sock.connect(socket_path)
+                        sock.sendall(b"nobody\n")
+                        self.assertEqual(sock.recv(65536), b"")
+                finally:
+                    server.terminate()
+
     def test_run_authorized_keys_check(self):
         out = StringIO()
         sys.stdout = out
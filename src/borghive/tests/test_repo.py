@@ -1,20 +1,55 @@
 import datetime
 import os
+import struct
 import tempfile
+import time
 
 import unittest
-from unittest import skip
+from unittest import mock, skip
 
+import msgpack
 from django.conf import settings
+from django.core.cache import cache
 from django.test import Client
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth.models import User
 
 import borghive.exceptions
-from borghive.models import Repository, RepositoryEvent, RepositoryStatistic
+from borghive.models import (
+    Repository,
+    RepositoryEvent,
+    RepositoryLocation,
+    RepositoryStatistic,
+)
+from borghive.models.repository import RepositoryMode
 from borghive.forms import RepositoryForm
+from borghive.lib.borg_index import (
+    HEADER,
+    count_index_entries,
+    get_chunk_count,
+    get_compaction_debt,
+    get_index_path,
+    read_index_header,
+)
+from borghive.lib.refresh_schedule import (
+    chunk_duration,
+    estimate_costs,
+    expected_duration,
+    pack_chunks,
+)
+from borghive.lib.routing import get_location_queue, get_repo_queue, location_queue
+from borghive.lib.scanner import refresh_repositories, scan_repository_dir
+from borghive.lib.stagger import (
+    DAY,
+    allowed_intervals,
+    is_due,
+    next_run,
+    parse_hours,
+    refresh_offset,
+)
+from borghive.tasks.repo import REFRESH_LAST_EVENT, STAGGER_LAST_SWEEP
 
 
 class RepositoryCreateTest(TestCase):
@@ -85,6 +120,12 @@ class RepositoryTest(TestCase):
             size = borghive.tasks.get_repo_size(repo.id)
             self.assertEqual(size, 1.0)
 
+    def test_repo_size_tracked(self):
+        repo = Repository.objects.get(name="test")
+        repo.size_bytes = 3 * 1024 * 1024 + 1
+        with mock.patch.dict(settings.BORGHIVE, {"REPO_SIZE_TRACKING": True}):
+            self.assertEqual(repo.get_repo_size(), 4)
+
     def test_repo_statistic_create(self):
         repo = Repository.objects.first()
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -97,6 +138,25 @@ class RepositoryTest(TestCase):
             borghive.tasks.create_repo_statistic(repo.id)
             self.assertEqual(repo.repositorystatistic_set.count(), 1)
 
+    @mock.patch("borghive.signals.schedule_authorized_keys_update")
+    def test_authorized_keys_update(self, mock_update):
+        repo = Repository.objects.get(id=2)
+        with mock.patch.dict(settings.BORGHIVE, {"AUTHORIZED_KEYS_STORE": True}):
+            repo.last_access = timezone.now()
+            repo.save()
+            repo.save(update_fields=["last_access"])
+            mock_update.assert_not_called()
+
+            repo.mode = RepositoryMode.IMPORT
+            repo.save()
+            mock_update.assert_called_once_with(["abulfj66"])
+            repo.save()
+            mock_update.assert_called_once()
+
+            repo.repo_user_id = 1
+            repo.save()
+            mock_update.assert_called_with(["xhmqhnsx", "abulfj66"])
+
     @skip("TODO")
     def test_valid_refresh(self):
         repo = Repository.objects.first()
@@ -104,6 +164,367 @@ class RepositoryTest(TestCase):
         repo.refresh()
 
 
+def write_borg_index(path, num_entries, num_buckets=8):
+    """synthetic borg 1.x repository index with 32 byte keys and 8 byte values"""
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(b"BORG_IDX", num_entries, num_buckets, 32, 8))
+        for bucket in range(num_buckets):
+            f.write(bucket.to_bytes(32, "little"))
+            if bucket < num_entries:
+                f.write(struct.pack("<II", 1, bucket * 100))
+            else:
+                f.write(struct.pack("<II", 0xFFFFFFFF, 0))
+
+
+class BorgIndexTest(TestCase):
+    def test_header(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_borg_index(os.path.join(temp_dir, "index.7"), 5)
+            write_borg_index(os.path.join(temp_dir, "index.12"), 3)
+            open(os.path.join(temp_dir, "index.tmp"), "a").close()
+            path = get_index_path(temp_dir)
+            self.assertEqual(path, os.path.join(temp_dir, "index.12"))
+            self.assertEqual(read_index_header(path), (3, 8, 32, 8))
+            self.assertEqual(count_index_entries(path), 3)
+            self.assertEqual(get_chunk_count(temp_dir), 3)
+
+    def test_invalid(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "index.1")
+            self.assertIsNone(read_index_header(path))
+            with open(path, "wb") as f:
+                f.write(b"BORG2IDX" + bytes(HEADER.size))
+            self.assertIsNone(read_index_header(path))
+            write_borg_index(path, 2)
+            with open(path, "r+b") as f:
+                f.truncate(HEADER.size + 10)
+            self.assertIsNone(count_index_entries(path))
+
+
+class CompactionDebtTest(TestCase):
+    def test_hints(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertIsNone(get_compaction_debt(temp_dir))
+            # borg 1.1 packs the keys as bytes
+            with open(os.path.join(temp_dir, "hints.3"), "wb") as f:
+                f.write(
+                    msgpack.packb(
+                        {b"version": 2, b"compact": {1: 100, 2: 0, 3: 50}},
+                        use_bin_type=False,
+                    )
+                )
+            self.assertEqual(get_compaction_debt(temp_dir), (150, 2))
+            with open(os.path.join(temp_dir, "hints.4"), "wb") as f:
+                f.write(msgpack.packb({"version": 1, "compact": [1, 2]}))
+            self.assertEqual(get_compaction_debt(temp_dir), (None, 2))
+            with open(os.path.join(temp_dir, "hints.5"), "wb") as f:
+                f.write(b"\xc1")
+            self.assertIsNone(get_compaction_debt(temp_dir))
+
+
+class RepositoryScannerTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def create_repo(self, repo, encrypted=False, size=0):
+        path = repo.get_repo_path()
+        os.makedirs(os.path.join(path, "data", "0"))
+        with open(os.path.join(path, "config"), "w", encoding="utf-8") as f:
+            f.write("[repository]\nversion = 1\nsegments_per_dir = 1000\n")
+            if encrypted:
+                f.write("key = secret\n")
+        write_borg_index(os.path.join(path, "index.5"), 4)
+        with open(os.path.join(path, "hints.5"), "wb") as f:
+            f.write(msgpack.packb({"version": 2, "compact": {1: 100, 2: 0, 3: 50}}))
+        with open(os.path.join(path, "data", "0", "1"), "wb") as f:
+            f.write(b"\0" * size)
+        return path
+
+    def test_scan_repository_dir(self):
+        repo = Repository.objects.get(name="test")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            settings.BORGHIVE["REPO_PATH"] = temp_dir
+            self.assertIsNone(scan_repository_dir(repo.get_repo_path()))
+            path = self.create_repo(repo, encrypted=True, size=10)
+            scan = scan_repository_dir(path)
+        self.assertTrue(scan.created)
+        self.assertTrue(scan.encrypted)
+        self.assertEqual(scan.size_bytes, 10)
+        self.assertIsNotNone(scan.last_updated)
+        self.assertNotIn("key", scan.storage_config)
+        self.assertIsNone(scan.error)
+
+    def test_refresh_unreadable(self):
+        repo = Repository.objects.get(name="test")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            settings.BORGHIVE["REPO_PATH"] = temp_dir
+            self.create_repo(repo)
+            other = Repository.objects.exclude(id=repo.id).first()
+            self.create_repo(other, size=10)
+            with mock.patch(
+                "borghive.lib.scanner.get_data_size",
+                side_effect=[PermissionError(13, "Permission denied"), 10],
+            ):
+                refreshed, failed = refresh_repositories(
+                    [repo, other], workers=1, pool="thread"
+                )
+        self.assertEqual((refreshed, failed), ([other], [repo]))
+        repo.refresh_from_db()
+        self.assertIsNone(repo.size_verified)
+
+    def test_refresh_repositories(self):
+        repo = Repository.objects.get(name="test")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            settings.BORGHIVE["REPO_PATH"] = temp_dir
+            self.create_repo(repo, size=1024 * 1024 + 1)
+            Repository.objects.filter(name="import").update(initialized=True)
+            with self.assertNumQueries(4):
+                refreshed, failed = refresh_repositories(
+                    Repository.objects.select_related("repo_user"), workers=2
+                )
+        self.assertEqual((refreshed, failed), ([repo], []))
+        repo.refresh_from_db()
+        self.assertGreater(repo.last_updated, timezone.now() - datetime.timedelta(1))
+        self.assertEqual(repo.size_bytes, 1024 * 1024 + 1)
+        self.assertEqual(repo.repositorystatistic_set.get().repo_size, 2)
+        self.assertEqual(repo.repositorystatistic_set.get().chunk_count, 4)
+        self.assertTrue(repo.initialized)
+        self.assertFalse(repo.encrypted)
+        self.assertEqual(
+            repo.storage_config, {"version": "1", "segments_per_dir": "1000"}
+        )
+        self.assertFalse(Repository.objects.get(name="import").initialized)
+        self.assertEqual((repo.compact_bytes, repo.compact_segments), (150, 2))
+
+    def test_fleet_refresh_chunks(self):
+        Repository.objects.filter(id=2).update(refresh_duration=100)
+        Repository.objects.filter(id=3).update(refresh_duration=1, size_bytes=1000)
+        Repository.objects.filter(id=4).update(size_bytes=50000)
+        with mock.patch.dict(
+            settings.BORGHIVE,
+            {"REFRESH_CHUNK_SIZE": 2, "REFRESH_WORKERS": 4, "SCAN_WORKERS": 8},
+        ):
+            with mock.patch("borghive.tasks.repo.chord") as mock_chord:
+                expected = borghive.tasks.create_repo_statistic()
+        chunks = [signature.args[0] for signature in mock_chord.call_args.args[0]]
+        # the largest repository first, the smallest fills up its chunk
+        self.assertEqual(chunks, [[2, 3], [5, 4]])
+        self.assertEqual(expected, 100)
+        summary = mock_chord.return_value.call_args.args[0]
+        self.assertEqual(summary.task, "borghive.tasks.repo.refresh_summary")
+
+    def test_refresh_schedule(self):
+        costs = {1: 5, 2: 4, 3: 3, 4: 3, 5: 3}
+        self.assertEqual(pack_chunks(costs, 2), [(10, [2, 3, 5]), (8, [1, 4])])
+        self.assertEqual(expected_duration([3, 2, 2], workers=2), 4)
+        self.assertEqual(chunk_duration(costs, [1, 4], scan_workers=2), 5)
+        self.assertEqual(
+            estimate_costs([(1, 1000, 2.0), (2, 500, None), (3, None, None)]),
+            {1: 2.0, 2: 1.0, 3: 2.0},
+        )
+
+    def test_refresh_repo_chunk(self):
+        repo = Repository.objects.get(name="test")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            settings.BORGHIVE["REPO_PATH"] = temp_dir
+            self.create_repo(repo)
+            result = borghive.tasks.refresh_repo_chunk([repo.id, 3])
+            with mock.patch(
+                "borghive.lib.scanner.get_data_size",
+                side_effect=PermissionError(13, "Permission denied"),
+            ):
+                unreadable = borghive.tasks.refresh_repo_chunk([repo.id, 3])
+            with mock.patch(
+                "borghive.tasks.repo.refresh_repositories",
+                side_effect=PermissionError("denied"),
+            ):
+                failed = borghive.tasks.refresh_repo_chunk([repo.id, 3])
+        self.assertEqual((result["repos"], result["refreshed"]), (2, 1))
+        self.assertEqual(failed["failed"], 2)
+        self.assertEqual((unreadable["refreshed"], unreadable["failed"]), (0, 1))
+
+        summary = borghive.tasks.refresh_summary([result, failed], 0)
+        self.assertEqual((summary["repos"], summary["failed"]), (4, 2))
+
+    def test_list_without_filesystem(self):
+        repo = Repository.objects.get(name="test")
+        Repository.objects.filter(id=repo.id).update(initialized=True, encrypted=True)
+        settings.BORGHIVE["REPO_PATH"] = "/nonexistent"
+        client = Client()
+        client.force_login(repo.owner)
+        with mock.patch.object(Repository, "is_created") as mock_created:
+            response = client.get(reverse("repository-list"))
+        self.assertEqual(response.status_code, 200)
+        mock_created.assert_not_called()
+        self.assertContains(response, "cil-lock-locked")
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class DebouncedRefreshTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch("borghive.tasks.repo.debounced_repo_refresh.apply_async")
+    def test_burst(self, mock_schedule):
+        with mock.patch.dict(settings.BORGHIVE, {"REFRESH_DEBOUNCE": 60}):
+            for _ in range(3):
+                borghive.tasks.schedule_repo_refresh(2)
+            borghive.tasks.schedule_repo_refresh(3)
+        self.assertEqual(
+            mock_schedule.call_args_list,
+            [
+                mock.call(args=[2], countdown=60),
+                mock.call(args=[3], countdown=60),
+            ],
+        )
+
+    @mock.patch("borghive.tasks.repo.create_repo_statistic")
+    @mock.patch("borghive.tasks.repo.debounced_repo_refresh.apply_async")
+    def test_trailing_refresh(self, mock_schedule, mock_refresh):
+        with mock.patch.dict(settings.BORGHIVE, {"REFRESH_DEBOUNCE": 60}):
+            borghive.tasks.schedule_repo_refresh(2)
+            # updated again while the refresh was waiting
+            borghive.tasks.debounced_repo_refresh(2)
+            self.assertEqual(mock_schedule.call_count, 2)
+            self.assertGreater(mock_schedule.call_args.kwargs["countdown"], 59)
+            mock_refresh.assert_not_called()
+
+            cache.set(REFRESH_LAST_EVENT.format(2), time.time() - 61)
+            borghive.tasks.debounced_repo_refresh(2)
+            mock_refresh.assert_called_once_with(repo_id=2)
+
+            # the next burst schedules a new refresh
+            borghive.tasks.schedule_repo_refresh(2)
+            self.assertEqual(mock_schedule.call_count, 3)
+
+    @mock.patch("borghive.tasks.repo.create_repo_statistic.apply_async")
+    def test_disabled(self, mock_refresh):
+        with mock.patch.dict(settings.BORGHIVE, {"REFRESH_DEBOUNCE": 0}):
+            borghive.tasks.schedule_repo_refresh(2)
+        mock_refresh.assert_called_once_with(kwargs={"repo_id": 2})
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class StaggerTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_intervals(self):
+        self.assertEqual(
+            allowed_intervals(parse_hours("0-24"), parse_hours("22-6")),
+            [(6 * 3600, 22 * 3600)],
+        )
+        intervals = allowed_intervals(parse_hours("20-8"), parse_hours("0-2"))
+        self.assertEqual(intervals, [(2 * 3600, 8 * 3600), (20 * 3600, 24 * 3600)])
+        for repo_id in range(200):
+            offset = refresh_offset(repo_id, intervals)
+            self.assertTrue(any(start <= offset < end for start, end in intervals))
+        with self.assertRaises(ValueError):
+            allowed_intervals(parse_hours("1-5"), parse_hours("0-6"))
+
+    def test_next_run(self):
+        now = datetime.datetime(2026, 10, 17, 12, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(next_run(3600, DAY, now), now + datetime.timedelta(hours=13))
+        self.assertTrue(is_due(13 * 3600, DAY, now, now + datetime.timedelta(hours=1)))
+        self.assertFalse(is_due(13 * 3600, DAY, now, now + datetime.timedelta(1) / 48))
+
+    @mock.patch("borghive.tasks.repo.alert_guard_tour.delay")
+    @mock.patch("borghive.tasks.repo.refresh_repo_chunk.apply_async")
+    def test_sweep(self, mock_refresh, mock_alert):
+        with mock.patch.dict(settings.BORGHIVE, {"STAGGER": False}):
+            self.assertIsNone(borghive.tasks.staggered_sweep())
+
+        with mock.patch.dict(
+            settings.BORGHIVE,
+            {"STAGGER": True, "STAGGER_WINDOW": "0-24", "QUIET_HOURS": ""},
+        ):
+            # a day since the last sweep: every repository is due
+            cache.set(
+                STAGGER_LAST_SWEEP,
+                timezone.now() - datetime.timedelta(hours=23, minutes=59, seconds=59),
+            )
+            self.assertEqual(borghive.tasks.staggered_sweep(), (4, 4))
+            mock_refresh.assert_called_once_with(args=[[2, 3, 4, 5]])
+            mock_alert.assert_called_once_with(repo_ids=[2, 3, 4, 5])
+
+            # fleet-wide runs are left to the sweep
+            with mock.patch("borghive.tasks.repo.chord") as mock_chord:
+                self.assertIsNone(borghive.tasks.create_repo_statistic())
+            mock_chord.assert_not_called()
+
+
+class LocationRoutingTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.storage = RepositoryLocation.objects.create(name="storage 2")
+        Repository.objects.filter(id__in=[4, 5]).update(location=self.storage)
+
+    def test_queues(self):
+        self.assertEqual(location_queue("storage 2"), "location.storage-2")
+        self.assertIsNone(get_repo_queue(4))
+        with mock.patch.dict(settings.BORGHIVE, {"LOCATION_ROUTING": True}):
+            self.assertEqual(get_repo_queue(4), "location.storage-2")
+            self.assertEqual(get_repo_queue(2), "location.localhost")
+            self.assertEqual(get_location_queue(self.storage.id), "location.storage-2")
+
+    def test_fleet_refresh(self):
+        with mock.patch.dict(
+            settings.BORGHIVE, {"LOCATION_ROUTING": True, "REFRESH_CHUNK_SIZE": 100}
+        ):
+            with mock.patch("borghive.tasks.repo.chord") as mock_chord:
+                borghive.tasks.create_repo_statistic()
+        chunks = {
+            signature.options["queue"]: sorted(signature.args[0])
+            for signature in mock_chord.call_args.args[0]
+        }
+        self.assertEqual(
+            chunks, {"location.localhost": [2, 3], "location.storage-2": [4, 5]}
+        )
+
+    @mock.patch("borghive.tasks.repo.repository_delete.apply_async")
+    def test_delete(self, mock_delete):
+        with mock.patch.dict(settings.BORGHIVE, {"LOCATION_ROUTING": True}):
+            Repository.objects.get(id=4).delete()
+        self.assertEqual(mock_delete.call_args.kwargs["queue"], "location.storage-2")
+
+    @mock.patch("borghive.tasks.repo.verify_repo_sizes.apply_async")
+    def test_verify_sizes(self, mock_verify):
+        with mock.patch.dict(settings.BORGHIVE, {"LOCATION_ROUTING": True}):
+            # the daily refresh scans the sizes without size tracking
+            borghive.tasks.verify_repo_sizes()
+            mock_verify.assert_not_called()
+            with mock.patch.dict(settings.BORGHIVE, {"REPO_SIZE_TRACKING": True}):
+                borghive.tasks.verify_repo_sizes()
+        self.assertEqual(
+            sorted(call.kwargs["queue"] for call in mock_verify.call_args_list),
+            ["location.localhost", "location.storage-2"],
+        )
+
+
 class RepositoryEventTest(TestCase):
 
     fixtures = [
@@ -1,7 +1,7 @@
 from django.test import TestCase
 from django.urls import reverse
 
-from core.celery import debug
+from core.celery import app, debug
 
 
 class CeleryTaskTest(TestCase):
@@ -15,3 +15,29 @@ class CeleryTaskTest(TestCase):
 
     def test_task_debug(self):
         debug()
+
+    def test_routes(self):
+        router = app.amqp.router
+        queues = {
+            name: router.route(options, name)["queue"].name
+            for name, options in (
+                ("borghive.tasks.repo.refresh_repo_chunk", {}),
+                ("borghive.tasks.repo.repository_delete", {"queue": None}),
+                ("borghive.tasks.alert.fire_alert", {}),
+                ("borghive.tasks.repo.staggered_sweep", {}),
+            )
+        }
+        self.assertEqual(
+            queues,
+            {
+                "borghive.tasks.repo.refresh_repo_chunk": "filesystem",
+                "borghive.tasks.repo.repository_delete": "filesystem",
+                "borghive.tasks.alert.fire_alert": "notify",
+                "borghive.tasks.repo.staggered_sweep": "celery",
+            },
+        )
+        # location routing takes precedence
+        route = router.route(
+            {"queue": "location.localhost"}, "borghive.tasks.repo.repository_delete"
+        )
+        self.assertEqual(route["queue"].name, "location.localhost")
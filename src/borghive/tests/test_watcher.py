@@ -0,0 +1,805 @@
+import asyncio
+import datetime
+import os
+import signal
+import struct
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.db import OperationalError, connection
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from borghive.lib.events import RepositoryEventBuffer
+from borghive.lib.reconcile import reconcile_repositories
+from borghive.lib.recording import EventRecorder, read_recording
+from borghive.lib.repo_index import RepositoryIndex
+from borghive.lib.repo_size import RepositorySizeTracker, get_data_size
+from borghive.lib.spool import EventSpool, SpoolDrainer
+from borghive.lib.watches import (
+    RepositoryWatches,
+    decode_events,
+    path_depth,
+    shard_filter,
+    shard_of,
+)
+from borghive.management.commands.watch_repositories import Command as WCommand
+from borghive.models import Repository, RepositoryEvent
+from borghive.signals import handle_repository_events
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RepositoryEventBufferTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.buffer = RepositoryEventBuffer(
+            debounce=2, flush_interval=5, flush_size=10, clock=self.clock
+        )
+        self.repo = Repository.objects.get(name="test")
+
+    def test_debounce(self):
+        self.assertTrue(self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED))
+        self.clock.now = 1
+        self.assertFalse(self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED))
+        self.clock.now = 4
+        self.assertTrue(self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED))
+        self.assertEqual(len(self.buffer), 2)
+
+    def test_collapse_close_open(self):
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_CLOSED)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_CLOSED)
+        self.assertEqual(
+            [event.message for event in self.buffer.pending],
+            [RepositoryEvent.REPO_OPEN, RepositoryEvent.REPO_CLOSED],
+        )
+
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_flush(self, mock_refresh):
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED)
+        self.clock.now = 3
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED)
+        self.buffer.flush_if_due()
+        self.assertEqual(RepositoryEvent.objects.count(), 0)
+
+        self.clock.now = 5
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush_if_due()
+        self.assertEqual(len([q for q in queries if q["sql"].startswith("INSERT")]), 1)
+        self.assertEqual(RepositoryEvent.objects.filter(repo=self.repo).count(), 3)
+        mock_refresh.assert_called_once_with(self.repo.id)
+        self.assertEqual(len(self.buffer), 0)
+
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_flush_size(self, mock_refresh):
+        for repo in Repository.objects.all():
+            self.buffer.add(repo.id, RepositoryEvent.REPO_OPEN)
+            self.buffer.add(repo.id, RepositoryEvent.REPO_CLOSED)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_CLOSED)
+        self.assertEqual(RepositoryEvent.objects.count(), 10)
+        self.assertEqual(len(self.buffer), 0)
+
+
+class EventSpoolTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.clock = FakeClock()
+        self.spool = EventSpool(self.tmp.name, fsync_interval=1, clock=self.clock)
+        self.buffer = RepositoryEventBuffer(clock=self.clock, spool=self.spool)
+        self.drainer = SpoolDrainer(
+            self.spool,
+            RepositoryEventBuffer.insert,
+            follow_up=handle_repository_events,
+        )
+        self.repo = Repository.objects.get(name="test")
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp.cleanup()
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_spool_and_drain(self, mock_refresh, mock_close):
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED)
+        self.buffer.flush()
+        self.assertEqual(RepositoryEvent.objects.count(), 0)
+        self.assertEqual(self.spool.backlog()["segments"], 1)
+
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(RepositoryEvent.objects.filter(repo=self.repo).count(), 2)
+        self.assertEqual(self.spool.backlog()["segments"], 0)
+        self.assertEqual(self.drainer.stats()["drained"], 2)
+        mock_refresh.assert_called_once_with(self.repo.id)
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_event_time(self, mock_refresh, mock_close):
+        happened = timezone.now().replace(microsecond=0) - datetime.timedelta(hours=1)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.pending[0].created = happened
+        self.buffer.flush()
+
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(RepositoryEvent.objects.get(repo=self.repo).created, happened)
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_broker_unavailable(self, mock_refresh, mock_close):
+        mock_refresh.side_effect = OSError("broker gone")
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_UPDATED)
+        self.buffer.flush()
+
+        # the events are committed, the segment must not be written again
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(self.spool.backlog()["segments"], 0)
+        self.assertTrue(self.drainer.drain())
+        self.assertEqual(RepositoryEvent.objects.filter(repo=self.repo).count(), 1)
+        mock_refresh.assert_called_once_with(self.repo.id)
+
+    @mock.patch("django.db.close_old_connections")
+    def test_drain_error(self, mock_close):
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.flush()
+        with mock.patch.object(
+            self.spool,
+            "read_segment",
+            side_effect=UnicodeDecodeError("utf-8", b"", 0, 1, "bad"),
+        ):
+            self.drainer.drain_logged()
+        self.assertEqual(self.drainer.failures, 1)
+        self.drainer.drain_logged()
+        self.assertEqual(self.drainer.failures, 0)
+        self.assertEqual(self.spool.backlog()["segments"], 0)
+
+    @mock.patch("django.db.close_old_connections")
+    def test_database_unavailable(self, mock_close):
+        writer = mock.Mock(side_effect=OperationalError("gone"))
+        drainer = SpoolDrainer(self.spool, writer, interval=1)
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.flush()
+
+        self.assertFalse(drainer.drain())
+        self.assertFalse(drainer.drain())
+        self.assertEqual(drainer.stats()["failures"], 2)
+        self.assertEqual(drainer.delay, 4)
+        self.assertEqual(self.spool.backlog()["segments"], 1)
+
+        writer.side_effect = None
+        self.assertTrue(drainer.drain())
+        self.assertEqual(len(writer.call_args[0][0]), 1)
+        self.assertEqual(drainer.delay, 1)
+        self.assertEqual(self.spool.backlog()["segments"], 0)
+
+    def test_torn_line(self):
+        self.buffer.add(self.repo.id, RepositoryEvent.REPO_OPEN)
+        self.buffer.flush()
+        segment = self.spool.file.name
+        self.spool.close()
+        with open(segment, "a", encoding="utf-8") as f:
+            f.write('{"repo": 2, "mess')
+        events = self.spool.read_segment(segment)
+        self.assertEqual(
+            [event.message for event in events], [RepositoryEvent.REPO_OPEN]
+        )
+
+
+class RepositoryIndexTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.index = RepositoryIndex(refresh_interval=60, miss_ttl=30, clock=self.clock)
+        self.repo = Repository.objects.get(name="test")
+
+    @mock.patch("django.db.close_old_connections")
+    def test_known_repo_without_queries(self, mock_close):
+        self.index.load()
+        self.assertEqual(len(self.index), Repository.objects.count())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.get("abulfj66", "test"), self.repo.id)
+
+    @mock.patch("django.db.close_old_connections")
+    def test_negative_cache(self, mock_close):
+        self.index.load()
+        self.assertFalse(self.index.is_cached("unknown", "test"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.index.get("unknown", "test"))
+            self.assertIsNone(self.index.get("unknown", "test"))
+        self.assertTrue(self.index.is_cached("unknown", "test"))
+        self.clock.now = 31
+        self.assertFalse(self.index.is_cached("unknown", "test"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.index.get("unknown", "test"))
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.repository_delete.apply_async")
+    def test_refresh(self, mock_delete, mock_close):
+        self.index.load()
+        repo_id = self.repo.id
+        self.repo.delete()
+        self.index.refresh_if_due()
+        self.assertEqual(self.index.get("abulfj66", "test"), repo_id)
+
+        self.clock.now = 60
+        self.index.refresh_if_due()
+        self.assertIsNone(self.index.repos.get(("abulfj66", "test")))
+
+
+class RepositoryWatchesTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, "abulfj66", "test", "data", "0"))
+        self.watches = RepositoryWatches(self.root, block_duration_s=0.1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def events(self):
+        return [
+            (path, filename, type_names)
+            for (_, type_names, path, filename) in self.watches.event_gen(
+                timeout_s=0.3, yield_nones=False
+            )
+        ]
+
+    def test_path_depth(self):
+        self.assertEqual(path_depth("/repos", "/repos"), 0)
+        self.assertEqual(path_depth("/repos", "/repos/abulfj66"), 1)
+        self.assertEqual(path_depth("/repos", "/repos/abulfj66/test"), 2)
+        self.assertEqual(path_depth("/repos", "/repos/abulfj66/test/data/0"), 4)
+
+    def test_load_skips_segment_directories(self):
+        self.watches.load()
+        self.assertEqual(
+            self.watches.paths,
+            {
+                self.root,
+                os.path.join(self.root, "abulfj66"),
+                os.path.join(self.root, "abulfj66", "test"),
+            },
+        )
+
+    def test_segment_writes_are_not_reported(self):
+        self.watches.load()
+        segment = os.path.join(self.root, "abulfj66", "test", "data", "0", "1")
+        with open(segment, "wb") as f:
+            f.write(b"data")
+        self.assertEqual(self.events(), [])
+
+    def test_new_repository(self):
+        self.watches.load()
+        repo_path = os.path.join(self.root, "abulfj66", "new")
+        os.mkdir(repo_path)
+        with open(os.path.join(repo_path, "README"), "w", encoding="utf-8") as f:
+            f.write("borg")
+        events = self.events()
+        self.assertIn(repo_path, self.watches.paths)
+        self.assertIn((repo_path, "README", ["IN_CREATE"]), events)
+
+        os.rmdir(os.path.join(self.root, "abulfj66", "test", "data", "0"))
+        os.rmdir(os.path.join(self.root, "abulfj66", "test", "data"))
+        os.rmdir(os.path.join(self.root, "abulfj66", "test"))
+        self.events()
+        self.assertNotIn(
+            os.path.join(self.root, "abulfj66", "test"), self.watches.paths
+        )
+
+    def test_track_size(self):
+        watches = RepositoryWatches(self.root, block_duration_s=0.1, track_size=True)
+        watches.load()
+        data_path = os.path.join(self.root, "abulfj66", "test", "data")
+        self.assertIn(os.path.join(data_path, "0"), watches.paths)
+
+        os.mkdir(os.path.join(data_path, "1"))
+        with open(os.path.join(data_path, "1", "2"), "wb") as f:
+            f.write(b"data")
+        events = [
+            (path, filename, type_names)
+            for (_, type_names, path, filename) in watches.event_gen(
+                timeout_s=0.3, yield_nones=False
+            )
+        ]
+        self.assertIn(os.path.join(data_path, "1"), watches.paths)
+        self.assertIn((os.path.join(data_path, "1"), "2", ["IN_CLOSE_WRITE"]), events)
+        watches.close()
+
+
+class RepositorySizeTrackerTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.repo_dir = os.path.join(self.tmp.name, "abulfj66", "test")
+        self.segment_dir = os.path.join(self.repo_dir, "data", "0")
+        os.makedirs(self.segment_dir)
+        self.repo = Repository.objects.get(name="test")
+        self.tracker = RepositorySizeTracker()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_segment(self, name, size):
+        segment = os.path.join(self.segment_dir, name)
+        with open(segment, "wb") as f:
+            f.write(b"\0" * size)
+        return segment
+
+    def test_get_data_size(self):
+        self.write_segment("1", 10)
+        self.write_segment("2", 5)
+        self.assertEqual(get_data_size(self.repo_dir), 15)
+        self.assertEqual(get_data_size(os.path.join(self.tmp.name, "missing")), 0)
+
+    def test_deltas(self):
+        self.repo.size_bytes = 100
+        self.repo.save()
+        first = self.write_segment("1", 10)
+        self.tracker.segment_written(self.repo.id, first)
+        self.tracker.segment_written(self.repo.id, self.write_segment("2", 20))
+        os.unlink(first)
+        self.tracker.segment_removed(self.repo.id, self.repo_dir, first)
+        self.tracker.flush()
+        self.repo.refresh_from_db()
+        self.assertEqual(self.repo.size_bytes, 120)
+
+    def test_unknown_segment_removed(self):
+        self.repo.size_bytes = 100
+        self.repo.save()
+        self.write_segment("1", 10)
+        self.tracker.segment_removed(
+            self.repo.id, self.repo_dir, os.path.join(self.segment_dir, "old")
+        )
+        self.tracker.flush()
+        self.repo.refresh_from_db()
+        self.assertEqual(self.repo.size_bytes, 10)
+        self.assertIsNotNone(self.repo.size_verified)
+
+    def test_segments_bounded(self):
+        tracker = RepositorySizeTracker(max_segments=2)
+        first = self.write_segment("1", 10)
+        for segment in (
+            first,
+            self.write_segment("2", 20),
+            self.write_segment("3", 30),
+        ):
+            tracker.segment_written(self.repo.id, segment)
+        self.assertEqual(len(tracker.segments), 2)
+        # the size of the evicted segment is unknown: the repository is scanned
+        tracker.segment_removed(self.repo.id, self.repo_dir, first)
+        self.assertEqual(tracker.dirty, {self.repo.id: self.repo_dir})
+
+    def test_database_unavailable(self):
+        self.tracker.segment_written(self.repo.id, self.write_segment("1", 10))
+        with mock.patch(
+            "borghive.models.Repository.objects.filter",
+            side_effect=OperationalError("down"),
+        ):
+            self.tracker.flush()
+        self.assertEqual(self.tracker.deltas[self.repo.id], 10)
+
+    def test_segment_event(self):
+        self.repo.size_bytes = 0
+        self.repo.save()
+        cmd = WCommand()
+        cmd.sizes = self.tracker
+        self.write_segment("1", 10)
+        cmd._process_event(
+            (None, ["IN_CLOSE_WRITE"], self.segment_dir, "1"), self.tmp.name
+        )
+        cmd._process_event(
+            (None, ["IN_CREATE", "IN_ISDIR"], self.segment_dir, "2"), self.tmp.name
+        )
+        self.assertEqual(len(cmd.buffer), 0)
+        self.tracker.flush()
+        self.repo.refresh_from_db()
+        self.assertEqual(self.repo.size_bytes, 10)
+
+
+class InotifyDecodeTest(TestCase):
+    def test_decode_events(self):
+        data = (
+            struct.pack("iIII", -1, 0x4000, 0, 0)
+            + struct.pack("iIII", 1, 0x100, 0, 16)
+            + b"lock.roster\0\0\0\0\0"
+            + struct.pack("iIII", 1, 0x200, 0, 16)
+        )
+        events, rest = decode_events(data)
+        self.assertEqual(events, [(-1, 0x4000, ""), (1, 0x100, "lock.roster")])
+        # incomplete event stays for the next read
+        self.assertEqual(len(rest), 16)
+
+
+class AsyncWatcherTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.lib.events.RepositoryEventBuffer.write")
+    def test_watch_async(self, mock_write, mock_close):
+        repo = Repository.objects.get(name="test")
+        with tempfile.TemporaryDirectory() as root:
+            repo_path = os.path.join(root, "abulfj66", "test")
+            os.makedirs(repo_path)
+            cmd = WCommand()
+            cmd.index.load()
+            watches = RepositoryWatches(root)
+            watches.load()
+            options = {
+                "repo_path": root,
+                "queue_size": 100,
+                "db_workers": 1,
+                "flush_size": 500,
+                "reconcile_workers": 1,
+            }
+
+            async def scenario():
+                task = asyncio.create_task(cmd.watch_async(watches, None, options))
+                await asyncio.sleep(0.1)
+                lock = os.path.join(repo_path, "lock.roster")
+                with open(lock, "w", encoding="utf-8"):
+                    pass
+                with open(
+                    os.path.join(repo_path, "index.5.tmp"), "w", encoding="utf-8"
+                ):
+                    pass
+                os.rename(
+                    os.path.join(repo_path, "index.5.tmp"),
+                    os.path.join(repo_path, "index.5"),
+                )
+                os.unlink(lock)
+                await asyncio.sleep(0.2)
+                os.unlink(os.path.join(repo_path, "index.5"))
+                os.rmdir(repo_path)
+                await asyncio.sleep(0.2)
+                cmd.stopping.set()
+                await task
+
+            # lookups and writes run in the pool, not in the event loop
+            with CaptureQueriesContext(connection) as loop_queries:
+                asyncio.run(scenario())
+            watches.close()
+
+        written = [event for call in mock_write.call_args_list for event in call[0][0]]
+        self.assertEqual(
+            [(event.repo_id, event.message) for event in written],
+            [
+                (repo.id, RepositoryEvent.REPO_OPEN),
+                (repo.id, RepositoryEvent.REPO_UPDATED),
+                (repo.id, RepositoryEvent.REPO_CLOSED),
+                (repo.id, RepositoryEvent.REPO_DELETED),
+            ],
+        )
+        self.assertEqual(len(loop_queries), 0)
+
+
+class ShardTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def test_shards_are_disjoint(self):
+        names = [f"user{i}" for i in range(100)]
+        filters = [shard_filter(4, shard) for shard in range(4)]
+        for name in names:
+            self.assertEqual(sum(f(name) for f in filters), 1)
+            self.assertTrue(filters[shard_of(name, 4)](name))
+        self.assertIsNone(shard_filter(1, 0))
+
+    @mock.patch("django.db.close_old_connections")
+    def test_sharded_index(self, mock_close):
+        shard = shard_of("abulfj66", 2)
+        own = RepositoryIndex(user_filter=shard_filter(2, shard))
+        other = RepositoryIndex(user_filter=shard_filter(2, 1 - shard))
+        own.load()
+        other.load()
+        self.assertEqual(len(own) + len(other), Repository.objects.count())
+        self.assertIsNotNone(own.get("abulfj66", "test"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(other.get("abulfj66", "test"))
+
+    def test_sharded_watches(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name in ("abulfj66", "6w9646gn", "7w9747gn", "8w9848gn"):
+                os.makedirs(os.path.join(root, name, "repo"))
+            watched = set()
+            for shard in range(2):
+                watches = RepositoryWatches(root, user_filter=shard_filter(2, shard))
+                watches.load()
+                users = watches.paths - {root}
+                self.assertFalse(users & watched)
+                watched |= users
+            self.assertEqual(len(watched), 8)
+
+    def test_shard_command(self):
+        cmd = WCommand()
+        parser = cmd.create_parser("manage.py", "watch_repositories")
+        options = vars(parser.parse_args(["--shards", "4"]))
+        args = cmd.shard_command(options, 3)
+        self.assertEqual(args[args.index("--shards") + 1], "4")
+        self.assertEqual(args[args.index("--shard") + 1], "3")
+        self.assertNotIn("--asyncio", args)
+        self.assertNotIn("--record", args)
+
+        options = vars(
+            parser.parse_args(
+                [
+                    "--shards",
+                    "4",
+                    "--asyncio",
+                    "--queue-size",
+                    "50",
+                    "--db-workers",
+                    "2",
+                    "--record",
+                    "/tmp/events.jsonl.gz",
+                ]
+            )
+        )
+        args = cmd.shard_command(options, 0)
+        self.assertEqual(
+            args[args.index("--record") + 1], "/tmp/events.jsonl.gz.shard0"
+        )
+        self.assertIn("--asyncio", args)
+        self.assertEqual(args[args.index("--queue-size") + 1], "50")
+        self.assertEqual(args[args.index("--db-workers") + 1], "2")
+
+
+class ReconcileTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def create_repo(self, repo_user, name, index=None):
+        path = os.path.join(self.root, repo_user, name)
+        os.makedirs(path)
+        for filename in ["README"] + ([index] if index else []):
+            with open(os.path.join(path, filename), "w", encoding="utf-8") as f:
+                f.write("borg")
+
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_reconcile(self, mock_refresh):
+        # updated since the last refresh
+        self.create_repo("abulfj66", "test", index="index.5")
+        # created, never seen by the watcher
+        self.create_repo("6w9646gn", "mytestrepo2.lan.local")
+        # known repository, removed from disk
+        Repository.objects.filter(name="import").update(last_updated=timezone.now())
+
+        with self.assertNumQueries(2):
+            missing = reconcile_repositories(self.root)
+        self.assertEqual(
+            sorted(missing),
+            sorted(
+                [
+                    (2, RepositoryEvent.REPO_UPDATED),
+                    (3, RepositoryEvent.REPO_CREATED),
+                    (5, RepositoryEvent.REPO_DELETED),
+                ]
+            ),
+        )
+
+        cmd = WCommand()
+        with CaptureQueriesContext(connection) as queries:
+            cmd.reconcile(self.root, None, {"reconcile_workers": 2})
+        self.assertEqual(len([q for q in queries if q["sql"].startswith("INSERT")]), 1)
+        mock_refresh.assert_called_once_with(2)
+
+        # everything is known now
+        self.assertEqual(reconcile_repositories(self.root), [])
+
+
+class WatcherTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_sigterm_flushes(self, mock_refresh, mock_close):
+        repo = Repository.objects.get(name="test")
+        cmd = WCommand()
+        watches = mock.Mock()
+
+        def event_gen(yield_nones):
+            yield (None, ["IN_CREATE"], "/repos/abulfj66/test", "lock.roster")
+            os.kill(os.getpid(), signal.SIGTERM)
+            yield None
+
+        watches.event_gen.side_effect = event_gen
+        previous = signal.getsignal(signal.SIGTERM)
+        try:
+            with self.assertRaises(SystemExit):
+                cmd.watch(watches, None, {"repo_path": "/repos"})
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        self.assertEqual(
+            list(
+                RepositoryEvent.objects.filter(repo=repo).values_list(
+                    "message", flat=True
+                )
+            ),
+            [RepositoryEvent.REPO_OPEN],
+        )
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_process_event(self, mock_refresh, mock_close):
+        repo = Repository.objects.get(name="test")
+        cmd = WCommand()
+        cmd._process_event(
+            (None, ["IN_CREATE"], "/repos/abulfj66/test", "lock.roster"), "/repos"
+        )
+        cmd._process_event(
+            (None, ["IN_MOVED_TO"], "/repos/abulfj66/test", "index.12"), "/repos"
+        )
+        cmd._process_event(
+            (None, ["IN_MOVED_TO"], "/repos/abulfj66/test", "index.14"), "/repos"
+        )
+        cmd._process_event(
+            (None, ["IN_DELETE"], "/repos/abulfj66/test", "lock.roster"), "/repos"
+        )
+        cmd._process_event(
+            (None, ["IN_CREATE"], "/repos/unknown/test", "lock.roster"), "/repos"
+        )
+        self.assertEqual(len(cmd.buffer), 3)
+        cmd.buffer.flush()
+        self.assertEqual(
+            list(repo.repositoryevent_set.values_list("message", flat=True)),
+            [
+                RepositoryEvent.REPO_OPEN,
+                RepositoryEvent.REPO_UPDATED,
+                RepositoryEvent.REPO_CLOSED,
+            ],
+        )
+        mock_refresh.assert_called_once_with(repo.id)
+
+
+class RecordReplayTest(TestCase):
+
+    fixtures = [
+        "testing/users.yaml",
+        "testing/sshpubkeys.yaml",
+        "testing/repositoryusers.yaml",
+        "testing/repositories.yaml",
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.recording = os.path.join(self.tmp.name, "events.jsonl.gz")
+        clock = FakeClock()
+        recorder = EventRecorder(self.recording, clock=clock)
+        for offset, type_names, filename in [
+            (0.0, ["IN_CREATE"], "lock.roster"),
+            (0.5, ["IN_MOVED_TO"], "index.12"),
+            (1.0, ["IN_MOVED_TO"], "index.14"),
+            (4.0, ["IN_MOVED_TO"], "index.16"),
+            (4.5, ["IN_DELETE"], "lock.roster"),
+        ]:
+            clock.now = offset
+            recorder.record((None, type_names, "/repos/abulfj66/test", filename))
+        recorder.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_recording(self):
+        recorded = list(read_recording(self.recording))
+        self.assertEqual(len(recorded), 5)
+        self.assertEqual(
+            recorded[1],
+            (0.5, (None, ["IN_MOVED_TO"], "/repos/abulfj66/test", "index.12")),
+        )
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_replay(self, mock_refresh, mock_close):
+        out = StringIO()
+        call_command(
+            "watch_repositories",
+            "--replay",
+            self.recording,
+            "--replay-speed",
+            "0",
+            "--replay-write",
+            stdout=out,
+        )
+        self.assertIn("replayed 5 events", out.getvalue())
+        self.assertIn("1 db writes", out.getvalue())
+        # the second update is debounced by the recorded time
+        self.assertEqual(
+            list(
+                RepositoryEvent.objects.filter(repo__name="test").values_list(
+                    "message", flat=True
+                )
+            ),
+            [
+                RepositoryEvent.REPO_OPEN,
+                RepositoryEvent.REPO_UPDATED,
+                RepositoryEvent.REPO_UPDATED,
+                RepositoryEvent.REPO_CLOSED,
+            ],
+        )
+
+    @mock.patch("django.db.close_old_connections")
+    @mock.patch("borghive.tasks.schedule_repo_refresh")
+    def test_replay_dry_run(self, mock_refresh, mock_close):
+        out = StringIO()
+        call_command(
+            "watch_repositories",
+            "--replay",
+            self.recording,
+            "--replay-speed",
+            "0",
+            stdout=out,
+        )
+        self.assertIn("1 db writes", out.getvalue())
+        self.assertIn("dry run", out.getvalue())
+        self.assertFalse(RepositoryEvent.objects.filter(repo__name="test").exists())
+        mock_refresh.assert_not_called()
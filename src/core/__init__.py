@@ -1 +1,10 @@
-from .celery import app
+def __getattr__(name):
+    """
+    load the celery app on first access (celery -A core), the sshd side
+    commands import core.settings_sshd and should not pay for celery
+    """
+    if name == "app":
+        from .celery import app  # pylint: disable=import-outside-toplevel
+
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
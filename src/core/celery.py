@@ -4,6 +4,8 @@ import logging
 import os
 
 from celery import Celery
+from celery.signals import worker_init
+from kombu import Queue
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
@@ -19,6 +21,60 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+# heavy filesystem work, latency-sensitive notifications and the remaining
+# bookkeeping on the default queue are consumed by separate worker pools
+FILESYSTEM_QUEUE = "filesystem"
+NOTIFY_QUEUE = "notify"
+DEFAULT_QUEUE = "celery"
+
+app.conf.task_default_queue = DEFAULT_QUEUE
+# a worker started without -Q consumes all of them
+app.conf.task_queues = [
+    Queue(DEFAULT_QUEUE),
+    Queue(FILESYSTEM_QUEUE),
+    Queue(NOTIFY_QUEUE),
+]
+app.conf.task_routes = {
+    "borghive.tasks.repo.create_repo_statistic": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.repo.debounced_repo_refresh": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.repo.refresh_repo_chunk": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.repo.get_repo_size": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.repo.verify_repo_sizes": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.repo.repository_delete": {"queue": FILESYSTEM_QUEUE},
+    "borghive.tasks.alert.fire_alert": {"queue": NOTIFY_QUEUE},
+}
+
+# pool defaults of a worker consuming only one of the queues: few long
+# filesystem tasks without prefetching, so a worker does not hold back tasks
+# behind a slow one. notifications wait on mail servers, not on cpu.
+QUEUE_DEFAULTS = {
+    FILESYSTEM_QUEUE: {"concurrency": 2, "prefetch_multiplier": 1},
+    NOTIFY_QUEUE: {"concurrency": 8, "prefetch_multiplier": 1},
+    DEFAULT_QUEUE: {"concurrency": 4, "prefetch_multiplier": 4},
+}
+
+
+@worker_init.connect
+def apply_queue_defaults(sender, **kwargs):  # pylint: disable=unused-argument
+    """
+    concurrency and prefetch of a worker started for a single queue
+
+    -c and --prefetch-multiplier on the command line take precedence.
+    """
+    queues = list(sender.app.amqp.queues.consume_from)
+    if len(queues) != 1:
+        return
+    # location queues (borghive.lib.routing) get the filesystem work
+    queue = FILESYSTEM_QUEUE if queues[0].startswith("location.") else queues[0]
+    if queue not in QUEUE_DEFAULTS:
+        return
+    defaults = QUEUE_DEFAULTS[queue]
+    if not sender.options.get("concurrency"):
+        sender.concurrency = defaults["concurrency"]
+    # the command line fills in the configured multiplier when not given
+    if sender.prefetch_multiplier == sender.app.conf.worker_prefetch_multiplier:
+        sender.prefetch_multiplier = defaults["prefetch_multiplier"]
+
 
 @app.task(bind=True)
 def debug(self):
@@ -180,6 +180,18 @@ CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", False)
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", "redis://redis:6379/0")
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
 
+#
+# Cache - shared by web, watcher and workers, e.g. to debounce tasks
+#
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": env("CACHE_URL", "redis://redis:6379/1"),
+    }
+}
+if TEST_MODE:
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+
 
 LOGGING = {
     "version": 1,
@@ -226,6 +238,11 @@ LOGGING = {
             "propagate": True,
             "level": env("AUTHORIZED_KEYS_CHECK_LOG_LEVEL", "DEBUG"),
         },
+        "borghive.management.commands.authorized_keys_server": {
+            "handlers": ["console"],
+            "propagate": True,
+            "level": env("AUTHORIZED_KEYS_CHECK_LOG_LEVEL", "DEBUG"),
+        },
         "borghive.management.commands.watch_repositories": {
             "handlers": ["console"],
             "propagate": True,
@@ -256,6 +273,38 @@ BORGHIVE = {
     "REPO_PATH": env("BORGHIVE_REPO_PATH", "/repos"),
     "SSH_PUBLIC_KEY_REGEX": r"^((ssh|ecdsa)-[a-zA-Z0-9-]+) (AAAA[0-9A-Za-z+/=]+)",
     "LDAP_USER_BASEDN": env("BORGHIVE_LDAP_USER_BASEDN", "dc=borghive,dc=local"),
+    "KEY_SERVER_SOCKET": env(
+        "BORGHIVE_KEY_SERVER_SOCKET", "/run/borghive/authorized_keys.sock"
+    ),
+    "AUTHORIZED_KEYS_STORE": env.bool("BORGHIVE_AUTHORIZED_KEYS_STORE", False),
+    "AUTHORIZED_KEYS_STORE_PATH": env(
+        "BORGHIVE_AUTHORIZED_KEYS_STORE_PATH",
+        os.path.join(env("CONFIG_PATH", "/config"), "authorized_keys"),
+    ),
+    "REPO_SIZE_TRACKING": env.bool("BORGHIVE_REPO_SIZE_TRACKING", False),
+    # workers of the nightly repository scan, "process" pools scan in processes
+    "SCAN_WORKERS": env.int("BORGHIVE_SCAN_WORKERS", 8),
+    "SCAN_POOL": env("BORGHIVE_SCAN_POOL", "thread"),
+    # repositories per task of the daily refresh
+    "REFRESH_CHUNK_SIZE": env.int("BORGHIVE_REFRESH_CHUNK_SIZE", 100),
+    # parallel refresh tasks of the workers (of each location with location
+    # routing), for the expected completion
+    "REFRESH_WORKERS": env.int("BORGHIVE_REFRESH_WORKERS", 4),
+    # seconds without "Repository updated" event before a repository is
+    # refreshed, 0 refreshes after every event
+    "REFRESH_DEBOUNCE": env.int("BORGHIVE_REFRESH_DEBOUNCE", 60),
+    # spread refreshes over the window (local hours) outside of the quiet
+    # hours and alert checks over the hour, instead of fleet-wide runs
+    "STAGGER": env.bool("BORGHIVE_STAGGER", False),
+    "STAGGER_WINDOW": env("BORGHIVE_STAGGER_WINDOW", "0-24"),
+    "QUIET_HOURS": env("BORGHIVE_QUIET_HOURS", ""),
+    # send filesystem tasks to the queue of the repository location
+    # ("location.<name>"), consumed by the workers on that storage node
+    "LOCATION_ROUTING": env.bool("BORGHIVE_LOCATION_ROUTING", False),
+    "WATCHER_SPOOL_PATH": env(
+        "BORGHIVE_WATCHER_SPOOL_PATH",
+        os.path.join(env("CONFIG_PATH", "/config"), "watcher-spool"),
+    ),
 }
 
 #
@@ -0,0 +1,41 @@
+"""
+Minimal Django settings for the sshd side commands of borghive.
+
+authorized_keys_check and authorized_keys_server only read repository users,
+repositories and ssh keys, so only the apps providing these models are loaded.
+The web stack, celery, signal handlers and the ldap database are left out to
+keep the cold start of a login short.
+
+Usage: DJANGO_SETTINGS_MODULE=core.settings_sshd ./manage.py authorized_keys_check --user <user>
+"""
+
+# pylint: skip-file
+
+from core.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "borghive.apps.BorgHiveSshdConfig",
+]
+
+MIDDLEWARE = []
+ROOT_URLCONF = "core.urls_sshd"
+
+DATABASES = {"default": DATABASES["default"]}  # noqa: F405
+DATABASE_ROUTERS = []
+
+# modules, which must not be imported by the sshd commands (see tests)
+SSHD_FORBIDDEN_IMPORTS = [
+    "celery",
+    "crispy_forms",
+    "django.contrib.admin",
+    "django_celery_beat",
+    "django_extensions",
+    "requests",
+    "rest_framework",
+]
+# import time budget of the sshd commands in microseconds (python -X importtime)
+SSHD_IMPORT_TIME_BUDGET = env.int(  # noqa: F405
+    "BORGHIVE_SSHD_IMPORT_TIME_BUDGET", 1500000
+)
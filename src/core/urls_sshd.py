@@ -0,0 +1,6 @@
+"""borghive URL Configuration of the sshd side commands (core.settings_sshd)
+
+the sshd commands serve no web requests, core.urls would import the admin
+"""
+
+urlpatterns = []